@@ -0,0 +1,339 @@
+"""Timing benchmarks for the hot paths.
+
+Times Swarm.update, example_physical_simulation, draw_M and Node.draw_tail
+separately over a grid of N, K and hist_length, writes the results as
+JSON or CSV, and compares them against a saved baseline.
+
+E.g. save a baseline, then check a change against it:
+
+    python benchmark.py --output baseline.json
+    python benchmark.py --baseline baseline.json
+"""
+import argparse
+import csv
+import itertools
+import json
+import sys
+import time
+from os import environ
+from dataclasses import asdict, dataclass, fields
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+from toolkit import Swarm, example_physical_simulation, draw_M, center_origin
+
+
+@dataclass
+class BenchmarkResult:
+    '''
+    Timing of one benchmark at one grid point, in seconds per call.
+
+    Parameters a benchmark doesn't depend on are None.
+    '''
+    name: str
+    N: int
+    K: Optional[int]
+    hist_length: Optional[int]
+    repeats: int
+    best: float
+    mean: float
+
+    @property
+    def key(self):
+        return (self.name, self.N, self.K, self.hist_length)
+
+
+def _setup_swarm_update(N, K, hist_length):
+    swarm = Swarm(N=N, hist_length=hist_length, rng=0)
+    return lambda: swarm.update(dt=1/60)
+
+
+def _setup_physical(N, K, hist_length):
+    coordinates = Swarm(N=N, hist_length=1, rng=0).coordinates
+    rng = np.random.default_rng(0)
+    return lambda: example_physical_simulation(coordinates, 1/60, K, rng=rng)
+
+
+def _screen(width=600, height=600):
+    environ['PYGAME_HIDE_SUPPORT_PROMPT'] = '1'
+    import pygame
+    return pygame.Surface((width, height))
+
+
+def _setup_draw_M(N, K, hist_length):
+    screen = _screen()
+    M = np.random.default_rng(0).random((N, K))
+    return lambda: draw_M(M, screen, corner=(4, 16), width=3)
+
+
+def _setup_draw_tail(N, K, hist_length):
+    screen = _screen()
+    swarm = Swarm(N=N, hist_length=hist_length, rng=0)
+    # Fill the history, so every tail is full length
+    for _ in range(hist_length):
+        swarm.update(dt=1/60)
+    transform = lambda coord: center_origin(coord, 600, 600)
+
+    def draw_tails():
+        for node in swarm.nodes:
+            node.draw_tail(screen, transform)
+    return draw_tails
+
+
+# Benchmark name: (setup, grid parameters it depends on)
+# setup(N, K, hist_length) returns the function to time
+BENCHMARKS = {
+    'swarm_update':  (_setup_swarm_update, ('N', 'hist_length')),
+    'physical':      (_setup_physical,     ('N', 'K')),
+    'draw_M':        (_setup_draw_M,       ('N', 'K')),
+    'draw_tail':     (_setup_draw_tail,    ('N', 'hist_length')),
+}
+
+
+def _time(function, repeats: int, min_time: float):
+    # Calls per repeat are chosen so that one repeat takes about min_time
+    function()
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time or number >= 2**20:
+            break
+        number *= 2
+
+    per_call = [elapsed / number]
+    for _ in range(repeats - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        per_call.append((time.perf_counter() - start) / number)
+    return min(per_call), float(np.mean(per_call))
+
+
+def run_benchmarks(
+    Ns: Sequence[int] = (40, 160, 640),
+    Ks: Sequence[int] = (10, 40),
+    hist_lengths: Sequence[int] = (1, 30),
+    names: Sequence[str] = tuple(BENCHMARKS),
+    repeats: int = 5,
+    min_time: float = 0.05,
+) -> List[BenchmarkResult]:
+    """Time each benchmark over its grid of N, K and hist_length.
+
+    Each benchmark only runs over the parameters it depends on,
+    e.g. swarm_update over N and hist_length but not K.
+
+    :param Ns: Numbers of nodes, defaults to (40, 160, 640)
+    :type Ns: Sequence[int], optional
+    :param Ks: Numbers of channels, defaults to (10, 40)
+    :type Ks: Sequence[int], optional
+    :param hist_lengths: Swarm history lengths, defaults to (1, 30)
+    :type hist_lengths: Sequence[int], optional
+    :param names: Benchmarks to run, keys of BENCHMARKS, defaults to all
+    :type names: Sequence[str], optional
+    :param repeats: Timing repeats per grid point, defaults to 5
+    :type repeats: int, optional
+    :param min_time: Minimum time in seconds of one repeat, defaults to 0.05
+    :type min_time: float, optional
+    :return: One result per benchmark per grid point
+    :rtype: List[BenchmarkResult]
+    """
+    results = []
+    for name in names:
+        setup, depends_on = BENCHMARKS[name]
+        grid = {
+            'N': Ns,
+            'K': Ks if 'K' in depends_on else (None,),
+            'hist_length': hist_lengths if 'hist_length' in depends_on else (None,),
+        }
+        for N, K, hist_length in itertools.product(grid['N'], grid['K'], grid['hist_length']):
+            function = setup(N, K, hist_length)
+            best, mean = _time(function, repeats, min_time)
+            results.append(BenchmarkResult(name, N, K, hist_length, repeats, best, mean))
+    return results
+
+
+def save_results(results: List[BenchmarkResult], path: str):
+    """Write results as CSV if path ends in .csv, otherwise as JSON.
+
+    :param results: Output of run_benchmarks
+    :type results: List[BenchmarkResult]
+    :param path: File to write
+    :type path: str
+    """
+    rows = [asdict(result) for result in results]
+    with open(path, 'w', newline='') as file:
+        if path.endswith('.csv'):
+            writer = csv.DictWriter(file, fieldnames=[field.name for field in fields(BenchmarkResult)])
+            writer.writeheader()
+            writer.writerows(rows)
+        else:
+            json.dump(rows, file, indent=2)
+
+
+def load_results(path: str) -> List[BenchmarkResult]:
+    """Read results written by save_results.
+
+    :param path: A .csv or .json file
+    :type path: str
+    :return: The results
+    :rtype: List[BenchmarkResult]
+    """
+    with open(path, newline='') as file:
+        if not path.endswith('.csv'):
+            return [BenchmarkResult(**row) for row in json.load(file)]
+        results = []
+        for row in csv.DictReader(file):
+            results.append(BenchmarkResult(
+                name = row['name'],
+                N = int(row['N']),
+                K = int(row['K']) if row['K'] else None,
+                hist_length = int(row['hist_length']) if row['hist_length'] else None,
+                repeats = int(row['repeats']),
+                best = float(row['best']),
+                mean = float(row['mean']),
+            ))
+        return results
+
+
+def compare(
+    results: List[BenchmarkResult],
+    baseline: List[BenchmarkResult],
+    threshold: float = 0.2,
+):
+    """Compare best times against a baseline, matching on benchmark and grid point.
+
+    :param results: New results
+    :type results: List[BenchmarkResult]
+    :param baseline: Saved results to compare against
+    :type baseline: List[BenchmarkResult]
+    :param threshold: Relative slowdown counted as a regression, defaults to 0.2 (20%)
+    :type threshold: float, optional
+    :return: The report, one line per matched result, and the regressed results
+    :rtype: Tuple[str, List[BenchmarkResult]]
+    """
+    previous: Dict[tuple, BenchmarkResult] = {result.key: result for result in baseline}
+    lines = [
+        "| benchmark | N | K | hist_length | baseline | now | change |",
+        "| --------- | - | - | ----------- | -------- | --- | ------ |",
+    ]
+    regressions = []
+    for result in results:
+        if result.key not in previous:
+            continue
+        before = previous[result.key].best
+        change = result.best / before - 1
+        flag = ""
+        if change > threshold:
+            regressions.append(result)
+            flag = " (regression)"
+        lines.append(
+            f"| {result.name} | {result.N} | {_blank(result.K)} | {_blank(result.hist_length)} "
+            f"| {_format_time(before)} | {_format_time(result.best)} | {change*100:+.1f}%{flag} |"
+        )
+    return "\n".join(lines), regressions
+
+
+def _blank(value):
+    return "" if value is None else f"{value}"
+
+
+def _format_time(seconds):
+    if seconds >= 1:
+        return f"{seconds:.2f} s"
+    if seconds >= 1e-3:
+        return f"{seconds*1e3:.2f} ms"
+    return f"{seconds*1e6:.1f} us"
+
+
+def markdown_table(results: List[BenchmarkResult]):
+    """Format results as a markdown table of best and mean time per call.
+
+    :param results: Output of run_benchmarks
+    :type results: List[BenchmarkResult]
+    :return: The table, one row per line
+    :rtype: str
+    """
+    lines = [
+        "| benchmark | N | K | hist_length | best | mean |",
+        "| --------- | - | - | ----------- | ---- | ---- |",
+    ]
+    for result in results:
+        lines.append(
+            f"| {result.name} | {result.N} | {_blank(result.K)} | {_blank(result.hist_length)} "
+            f"| {_format_time(result.best)} | {_format_time(result.mean)} |"
+        )
+    return "\n".join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Time the swarm, physical layer and renderer.")
+    parser.add_argument(
+        "--nodes","-n",
+        default=[40, 160, 640],
+        help="Numbers of nodes",
+        type=int, nargs='+'
+    )
+    parser.add_argument(
+        "--channels","-k",
+        default=[10, 40],
+        help="Numbers of channels",
+        type=int, nargs='+'
+    )
+    parser.add_argument(
+        "--hist",
+        default=[1, 30],
+        help="Swarm history (tail) lengths",
+        type=int, nargs='+'
+    )
+    parser.add_argument(
+        "--benchmarks","-b",
+        default=list(BENCHMARKS),
+        help="Benchmarks to run",
+        choices=list(BENCHMARKS), nargs='+'
+    )
+    parser.add_argument(
+        "--repeats","-r",
+        default=[5],
+        help="Timing repeats per configuration",
+        type=int, nargs=1
+    )
+    parser.add_argument(
+        "--output","-o",
+        default=[None],
+        help="Save results to this file, as .json or .csv",
+        type=str, nargs=1
+    )
+    parser.add_argument(
+        "--baseline",
+        default=[None],
+        help="Compare against results saved with --output; exits with 1 on regression",
+        type=str, nargs=1
+    )
+    parser.add_argument(
+        "--threshold",
+        default=[0.2],
+        help="Relative slowdown counted as a regression",
+        type=float, nargs=1
+    )
+    args = parser.parse_args()
+
+    results = run_benchmarks(
+        Ns=args.nodes, Ks=args.channels, hist_lengths=args.hist,
+        names=args.benchmarks, repeats=args.repeats[0]
+    )
+    print(markdown_table(results))
+
+    if args.output[0] is not None:
+        save_results(results, args.output[0])
+
+    if args.baseline[0] is not None:
+        report, regressions = compare(results, load_results(args.baseline[0]), args.threshold[0])
+        print()
+        print(report)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) over {args.threshold[0]*100:.0f}%")
+            sys.exit(1)
@@ -1,16 +1,42 @@
-import numpy as np
-from main import main
+import argparse
+from sweep import run_sweep, markdown_table
 
 Ns  = [2, 4, 8, 16, 32, 64, 128]
 K   = 32
 T   = 20
 FPS = 30
 
-print(f"Broadcast throughput ratio for variable N nodes communicating over {K} channels at {FPS} fps:")
-print()
-print("| N | throughput |")
-print("| - | ---------- |")
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="")
+    parser.add_argument(
+        "--workers","-w",
+        default=[None],
+        help="Number of worker processes, defaults to one per CPU",
+        type=int, nargs=1
+    )
+    parser.add_argument(
+        "--seeds",
+        default=[1],
+        help="Number of seeds (replicates) per configuration",
+        type=int, nargs=1
+    )
+    parser.add_argument(
+        "--target-width",
+        default=[None],
+        help="Stop each run once the throughput's 95% confidence interval is narrower than this",
+        type=float, nargs=1
+    )
+    args = parser.parse_args()
 
-for N in Ns:
-    throughput = main(N=N, K=K, fps=FPS, total_time=T, simplify_render=2, ratelimit=False)
-    print(f"| {N} | {throughput*100:.1f}% |")
+    print(f"Broadcast throughput ratio for variable N nodes communicating over {K} channels at {FPS} fps:")
+    print()
+
+    results = run_sweep(
+        Ns=Ns, Ks=[K], fpses=[FPS], Ts=[T],
+        seeds=range(args.seeds[0]), workers=args.workers[0],
+        target_width=args.target_width[0]
+    )
+    columns = ('N',)
+    if args.target_width[0] is not None:
+        columns += ('simulated',)
+    print(markdown_table(results, columns=columns))
@@ -1,18 +1,43 @@
-import numpy as np
-from main import main
+import argparse
+from sweep import run_sweep, markdown_table
 
 N=60
 K=10
 T=20
 FPSes = [2,3,6,12,30,60,120]
 
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="")
+    parser.add_argument(
+        "--workers","-w",
+        default=[None],
+        help="Number of worker processes, defaults to one per CPU",
+        type=int, nargs=1
+    )
+    parser.add_argument(
+        "--seeds",
+        default=[1],
+        help="Number of seeds (replicates) per configuration",
+        type=int, nargs=1
+    )
+    parser.add_argument(
+        "--target-width",
+        default=[None],
+        help="Stop each run once the throughput's 95% confidence interval is narrower than this",
+        type=float, nargs=1
+    )
+    args = parser.parse_args()
 
-print(f"Broadcast throughput ratio for {N} nodes communicating over {K} channels over {T} seconds, ")
-print("for different values of FPS.")
-print()
-print("| FPS | dt | throughput |")
-print("| --- | -- | ---------- |")
+    print(f"Broadcast throughput ratio for {N} nodes communicating over {K} channels over {T} seconds, ")
+    print("for different values of FPS.")
+    print()
 
-for fps in FPSes:
-    throughput = main(N=N, K=K, fps=fps, total_time=T, simplify_render=2, ratelimit=False)
-    print(f"| {fps} | {1/fps:.3f} | {throughput*100:.1f}% |")
+    results = run_sweep(
+        Ns=[N], Ks=[K], fpses=FPSes, Ts=[T],
+        seeds=range(args.seeds[0]), workers=args.workers[0],
+        target_width=args.target_width[0]
+    )
+    columns = ('fps', 'dt')
+    if args.target_width[0] is not None:
+        columns += ('simulated',)
+    print(markdown_table(results, columns=columns))
@@ -0,0 +1,281 @@
+"""Kernels for the physical layer: building D and counting receptions.
+
+Each kernel has a NumPy version and a loop version. The loops are
+compiled with numba when it is installed, and chosen at import, so
+BACKEND is 'numba' or 'numpy'. Both give identical results.
+"""
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+BACKEND = 'numpy' if numba is None else 'numba'
+
+
+def jit(function):
+    """Compile function with numba.njit if numba is installed, else return it unchanged.
+
+    Division follows NumPy, so 1/0 is inf rather than an error.
+    """
+    if numba is None:
+        return function
+    return numba.njit(cache=True, error_model='numpy')(function)
+
+
+def inverse_square_distances_numpy(coordinates, dtype = np.float64):
+    """Build the inverse-square distance matrix D by broadcasting.
+
+    D[i,j] = 1/((xi - xj)^2 + (yi - yj)^2), with a zero diagonal.
+    Leading axes are batch axes, e.g. (R, N, 2) gives (R, N, N).
+
+    :param coordinates: Array of x, y coordinates, shape (..., N, 2)
+    :type coordinates: np.ndarray
+    :param dtype: Dtype to compute D in, defaults to np.float64
+    :type dtype: type, optional
+    :return: D, shape (..., N, N)
+    :rtype: np.ndarray
+    """
+    coordinates = np.asarray(coordinates, dtype=dtype)
+    delta = coordinates[..., :, None, :] - coordinates[..., None, :, :]
+    distance_sq = delta[..., 0]**2 + delta[..., 1]**2
+    # inf on the diagonal so that D[i,i] = 1/inf = 0
+    diagonal = np.arange(distance_sq.shape[-1])
+    distance_sq[..., diagonal, diagonal] = np.inf
+    return 1 / distance_sq
+
+
+def inverse_square_distances_rows(coordinates, start: int, stop: int):
+    """Rows start:stop of D, i.e. from receivers start:stop to every node.
+
+    Gives the same values as inverse_square_distances_numpy(coordinates)[start:stop],
+    without building the other rows.
+
+    :param coordinates: Array of x, y coordinates, shape (N, 2)
+    :type coordinates: np.ndarray
+    :param start: First receiver
+    :type start: int
+    :param stop: One past the last receiver
+    :type stop: int
+    :return: D[start:stop], shape (stop - start, N)
+    :rtype: np.ndarray
+    """
+    coordinates = np.asarray(coordinates, dtype=float)
+    # in place, so only two (stop - start, N) arrays are ever allocated
+    distance_sq = np.subtract.outer(coordinates[start:stop, 0], coordinates[:, 0])
+    dy = np.subtract.outer(coordinates[start:stop, 1], coordinates[:, 1])
+    distance_sq *= distance_sq
+    dy *= dy
+    distance_sq += dy
+    del dy
+    rows = np.arange(len(distance_sq))
+    distance_sq[rows, start + rows] = np.inf
+    return np.divide(1, distance_sq, out=distance_sq)
+
+
+def inverse_square_distances_columns(coordinates, columns):
+    """Columns of D, i.e. from every node to the transmitters `columns`.
+
+    Gives the same values as inverse_square_distances_numpy(coordinates)[:, columns].
+
+    :param coordinates: Array of x, y coordinates, shape (N, 2)
+    :type coordinates: np.ndarray
+    :param columns: Node indices, shape (n,), repeats allowed
+    :type columns: np.ndarray
+    :return: D[:, columns], shape (N, n)
+    :rtype: np.ndarray
+    """
+    coordinates = np.asarray(coordinates, dtype=float)
+    columns = np.asarray(columns, dtype=int)
+    distance_sq = np.subtract.outer(coordinates[:, 0], coordinates[columns, 0])
+    dy = np.subtract.outer(coordinates[:, 1], coordinates[columns, 1])
+    distance_sq *= distance_sq
+    dy *= dy
+    distance_sq += dy
+    del dy
+    distance_sq[columns, np.arange(len(columns))] = np.inf
+    return np.divide(1, distance_sq, out=distance_sq)
+
+
+def inverse_square_distances_blocked(
+    coordinates,
+    dtype = np.float64,
+    block: int = 256,
+    min_distance: float = 1e-3,
+):
+    """Build D from the upper triangle only, in cache-sized tiles, and mirror it.
+
+    Squared distances come from |xi|^2 + |xj|^2 - 2 xi.xj, so each tile is one
+    BLAS product. Coordinates are centered first, which keeps the cancellation
+    error small, and pairs closer than min_distance are treated as being
+    min_distance apart. So coincident nodes get a large, finite D instead of
+    dividing by zero. Agrees with inverse_square_distances_numpy to rounding,
+    for pairs further apart than min_distance.
+
+    The expansion cancels badly for close pairs in reduced precision, so tiles
+    are always computed in float64, and only stored in dtype.
+
+    :param coordinates: Array of x, y coordinates, shape (N, 2)
+    :type coordinates: np.ndarray
+    :param dtype: Dtype to store D in, defaults to np.float64
+    :type dtype: type, optional
+    :param block: Tile size, in nodes, defaults to 256
+    :type block: int, optional
+    :param min_distance: Smallest distance between two distinct nodes, defaults to 1e-3
+    :type min_distance: float, optional
+    :return: D, shape (N, N)
+    :rtype: np.ndarray
+    """
+    coordinates = np.asarray(coordinates, dtype=np.float64)
+    N = len(coordinates)
+    if N:
+        coordinates = coordinates - coordinates.mean(axis=0)
+    norms = np.einsum('ij,ij->i', coordinates, coordinates)
+    floor = min_distance**2
+
+    D = np.empty((N, N), dtype=dtype)
+    for ii in range(0, N, block):
+        rows = slice(ii, min(ii + block, N))
+        for jj in range(ii, N, block):
+            columns = slice(jj, min(jj + block, N))
+            distance_sq = coordinates[rows] @ coordinates[columns].T
+            distance_sq *= -2
+            distance_sq += norms[rows, None]
+            distance_sq += norms[None, columns]
+            np.maximum(distance_sq, floor, out=distance_sq)
+            tile = np.divide(1, distance_sq, out=distance_sq)
+            if ii == jj:
+                # keep the upper half of the diagonal tile, so D is exactly symmetric
+                lower = np.tril_indices(len(tile))
+                tile[lower] = tile.T[lower]
+                np.fill_diagonal(tile, 0)
+            D[rows, columns] = tile
+            if ii != jj:
+                D[columns, rows] = tile.T
+    return D
+
+
+@jit
+def _inverse_square_distances_loop(coordinates):
+    N = coordinates.shape[0]
+    D = np.zeros((N, N))
+    for ii in range(N):
+        for jj in range(ii + 1, N):
+            dx = coordinates[ii, 0] - coordinates[jj, 0]
+            dy = coordinates[ii, 1] - coordinates[jj, 1]
+            D[ii, jj] = D[jj, ii] = 1 / (dx*dx + dy*dy)
+    return D
+
+
+def inverse_square_distances_loop(coordinates):
+    """inverse_square_distances_numpy, as an explicit loop over node pairs.
+
+    :param coordinates: Array of x, y coordinates, shape (N, 2)
+    :type coordinates: np.ndarray
+    :return: D, shape (N, N)
+    :rtype: np.ndarray
+    """
+    return _inverse_square_distances_loop(np.ascontiguousarray(coordinates, dtype=float))
+
+
+def count_receptions_batched(D, M, Ar):
+    """Count receptions, i.e. (i, j, k) with A[i,j,k] / Ar[i,k] > 1/2, per replica.
+
+    A[i,j,k] = D[i,j] * M[j,k] is zero wherever j is silent on k,
+    so only the active (transmitter, channel) pairs of M are checked.
+    This is O(N * messages sent) and never builds A.
+
+    :param D: Inverse-square distance matrices, shape (R, N, N)
+    :type D: np.ndarray
+    :param M: Message matrices, shape (R, N, K)
+    :type M: np.ndarray
+    :param Ar: Loudness per node per channel, D @ M, shape (R, N, K)
+    :type Ar: np.ndarray
+    :return: Messages received per replica, shape (R,)
+    :rtype: np.ndarray
+    """
+    rr, jj, kk = np.nonzero(M)
+    loudness = D[rr, :, jj]
+    total = Ar[rr, :, kk]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        received = (total != 0) & (loudness / total > 1/2)
+    return np.bincount(rr, weights=received.sum(axis=1), minlength=len(M)).astype(int)
+
+
+def count_receptions_numpy(D, M, Ar):
+    """count_receptions_batched for a single network.
+
+    D and Ar may also be a block of receiver rows, e.g. D[start:stop] and
+    Ar[start:stop], counting only the messages those receivers get.
+
+    :param D: Inverse-square distance matrix, shape (N, N)
+    :type D: np.ndarray
+    :param M: Message matrix, shape (N, K)
+    :type M: np.ndarray
+    :param Ar: Loudness per node per channel, D @ M, shape (N, K)
+    :type Ar: np.ndarray
+    :return: Total number of messages received
+    :rtype: int
+    """
+    return int(count_receptions_batched(D[None], M[None], Ar[None])[0])
+
+
+@jit
+def _count_receptions_loop(D, M, Ar):
+    N, K = M.shape
+    received = 0
+    for jj in range(N):
+        for kk in range(K):
+            if M[jj, kk] == 0:
+                continue
+            for ii in range(N):
+                total = Ar[ii, kk]
+                if total != 0 and D[ii, jj] / total > 0.5:
+                    received += 1
+    return received
+
+
+def count_receptions_loop(D, M, Ar):
+    """count_receptions_numpy, as an explicit loop over the active (j, k) pairs.
+
+    Same arguments and result as count_receptions_numpy.
+    """
+    return int(_count_receptions_loop(
+        np.ascontiguousarray(D),
+        np.ascontiguousarray(M),
+        np.ascontiguousarray(Ar),
+    ))
+
+
+def inverse_square_distances(coordinates, dtype = np.float64):
+    """Build D with the selected backend. See inverse_square_distances_numpy.
+
+    :param coordinates: Array of x, y coordinates, shape (..., N, 2)
+    :type coordinates: np.ndarray
+    :param dtype: Dtype to compute D in, defaults to np.float64
+    :type dtype: type, optional
+    :return: D, shape (..., N, N)
+    :rtype: np.ndarray
+    """
+    # the compiled loop is float64 only
+    if BACKEND == 'numba' and np.ndim(coordinates) == 2 and np.dtype(dtype) == np.float64:
+        return inverse_square_distances_loop(coordinates)
+    return inverse_square_distances_numpy(coordinates, dtype)
+
+
+def count_receptions(D, M, Ar):
+    """Count receptions with the selected backend. See count_receptions_batched.
+
+    :param D: Inverse-square distance matrix, shape (N, N)
+    :type D: np.ndarray
+    :param M: Message matrix, shape (N, K)
+    :type M: np.ndarray
+    :param Ar: Loudness per node per channel, D @ M, shape (N, K)
+    :type Ar: np.ndarray
+    :return: Total number of messages received
+    :rtype: int
+    """
+    if BACKEND == 'numba':
+        return count_receptions_loop(D, M, Ar)
+    return count_receptions_numpy(D, M, Ar)
@@ -6,16 +6,22 @@ import os
 import pickle
 import random
 import sys
+import threading
+import time
 
 import matplotlib
 import numpy as np
+from contextlib import nullcontext
+from dataclasses import dataclass
 
 from os import environ
 environ['PYGAME_HIDE_SUPPORT_PROMPT'] = '1'
 import pygame
 from pygame import freetype
 
-from toolkit import Node, Swarm, example_physical_simulation, center_origin, draw_M, _normalize_safe
+from toolkit import Node, Swarm, example_physical_simulation, center_origin, draw_M, draw_swarm, PhaseTimer, _normalize_safe
+from metrics import MetricsWriter
+from simulation import simulate
 from palette import S16, interpolate_color
 
 
@@ -29,6 +35,11 @@ def main(
     font_fn = "./assets/BitPotion.ttf",
     simplify_render: bool = False,
     ratelimit: bool = True,
+    seed = None,
+    threaded: bool = False,
+    metrics = None,
+    metrics_per_node: bool = False,
+    profile: bool = False,
 ):
     """Run the network experiment on the particle swarm.
 
@@ -52,12 +63,32 @@ def main(
     :type font_fn: str, optional
     :param simplify_render: Turn off tails and graphs, defaults to False
     :type simplify_render: bool, optional
-    # Note: simplify_render will remove printing and ALL rendering if set to 2
+    # Note: simplify_render will remove printing and ALL rendering if set to 2,
+    # running headless via simulation.simulate (no window is opened)
     :param ratelimit: Slow the simulation rendering if it runs faster than the display, defaults to True
     :type ratelimit: bool, optional
+    :param seed: Seed for the swarm and the messages, defaults to None (unseeded)
+    :type seed: int, optional
+    :param threaded: Simulate on a worker thread at a fixed dt, and render the
+        latest frame at display rate, dropping the rest. Defaults to False
+    :type threaded: bool, optional
+    :param metrics: File to stream per-frame metrics to (see metrics.MetricsWriter),
+        defaults to None (not recorded)
+    :type metrics: str, optional
+    :param metrics_per_node: Also record per-node counts in the metrics, defaults to False
+    :type metrics_per_node: bool, optional
+    :param profile: Time each phase of the loop, show the rolling averages
+        on screen and print a summary on exit, defaults to False
+    :type profile: bool, optional
     :return: Returns throughput rate on exit
     :rtype: float
     """
+    if simplify_render >= 2:
+        return simulate(
+            N=N, K=K, fps=fps, total_time=total_time, seed=seed,
+            metrics=metrics, metrics_per_node=metrics_per_node
+        ).throughput
+
     # See https://dr0id.bitbucket.io/legacy/pygame_tutorial00.html
     pygame.init()
     pygame.freetype.init()
@@ -71,93 +102,269 @@ def main(
     # dt is used in game logic. ideally is 1/fps
 
     #### Start simulation
-    swarm = Swarm(N=N, screen=screen, hist_length=int(1/(2*dt)))
-    M_to_draw = np.zeros((N,K))
-    Ar_to_draw = np.zeros((N,K))
-    
-    cum_tot_sent = []
-    cum_tot_recv = []
-
-    tt = 0 # timestep
-    ti = 0 # time index
-    while tt < total_time:
-        screen.fill(S16.black)
+    rng = np.random.default_rng(seed)
+    swarm = Swarm(N=N, screen=screen, hist_length=max(1, int(1/(2*dt))), rng=rng)
+    transform = lambda coord: center_origin(coord, width, height)
+    writer = None
+    if metrics is not None:
+        writer = MetricsWriter(metrics, K=K, N=N if metrics_per_node else 0)
+    timer = PhaseTimer(enabled=profile)
 
-        #### Handle controls
-        for ev in pygame.event.get():
-            if ev.type == pygame.QUIT:
-                return 0
-        
-        #### Handle physical simulation
-        swarm.update(dt=dt)
-        if simplify_render < 2:
-            swarm.draw(
-                screen,
-                transform = lambda coord: center_origin(coord, width, height),
-                tail = not simplify_render
+    if threaded:
+        with writer or nullcontext():
+            result = _main_threaded(
+                swarm, screen, font, clock, rng, K, dt, total_time,
+                transform, simplify_render, ratelimit, writer, timer
             )
+        if result is None:
+            _print_profile(timer)
+            return 0
+        sum_sent, sum_recv = result
+    else:
+        M_to_draw = np.zeros((N,K))
+        Ar_to_draw = np.zeros((N,K))
 
-        #### Handle network simulation
-        coordinates = np.zeros((N,2))
-        for ii in range(N):
-            coordinates[ii] = (swarm.nodes[ii].X[0], swarm.nodes[ii].Y[0])
-        
-        tot_sent, tot_recv, M, D, _, Ar = example_physical_simulation(coordinates, dt, K)
-
-        cum_tot_sent.append(tot_sent)
-        cum_tot_recv.append(tot_recv)
-
-        if not simplify_render:
-            #### Draw metadata
-            # Draw M and Ar here
-            fps_text = font.render('M and A\' visualization', S16.lime)
-            screen.blit(fps_text[0], (4,4))
-
-            # Draw M graph
-            M_to_draw = np.clip(M + (1-dt*6) * M_to_draw, 0, 1)
-            draw_M(corner=(4, 16), M=M_to_draw.T, screen=screen, width=3)
-
-            # Draw Ar graph
-            Ar_to_draw = np.clip(
-                _normalize_safe(Ar) + (1-dt*6) * Ar_to_draw,
-                0, 1
-            )
-            draw_M(corner=(13 + K*4, 16), M=Ar_to_draw.T, C1=S16.cyan, screen=screen, width=3)
-
-            # Draw D graph text
-            D_corner=(width - N*3 - 4, height-N*3 - 4)
-            fps_text = font.render('D visualization', S16.orange)
-            screen.blit(fps_text[0], (D_corner[0], D_corner[1] - 16))
-
-            # Draw D graph
-            D = _normalize_safe(D)**(1/4)
-            draw_M(
-                corner=D_corner,
-                M=D, screen=screen, width=3, border=0, C1=S16.orange
-            )
-        
+        # running totals, so memory doesn't grow with total_time
+        sum_sent = 0
+        sum_recv = 0
+
+        with writer or nullcontext():
+            tt = 0 # timestep
+            ti = 0 # time index
+            while tt < total_time:
+                screen.fill(S16.black)
+
+                #### Handle controls
+                with timer.phase('events'):
+                    events = pygame.event.get()
+                for ev in events:
+                    if ev.type == pygame.QUIT:
+                        _print_profile(timer)
+                        return 0
+
+                #### Handle physical simulation
+                with timer.phase('update'):
+                    swarm.update(dt=dt)
+                if simplify_render < 2:
+                    with timer.phase('draw'):
+                        swarm.draw(screen, transform = transform, tail = not simplify_render)
+
+                #### Handle network simulation
+                coordinates = swarm.coordinates
+                with timer.phase('physical'):
+                    tot_sent, tot_recv, M, D, _, Ar = example_physical_simulation(coordinates, dt, K, rng=rng)
+
+                sum_sent += tot_sent
+                sum_recv += tot_recv
+                if writer is not None:
+                    writer.record(tt + dt, tot_sent, tot_recv, M, D, Ar)
+
+                if not simplify_render:
+                    with timer.phase('draw_M'):
+                        M_to_draw, Ar_to_draw = _draw_network(
+                            screen, font, M, D, Ar, M_to_draw, Ar_to_draw, dt
+                        )
+                _draw_profile(screen, font, timer)
+
+                #### Update frames
+                # fixed dt = visual inconsistency but simulated consistency
+                # setting dt as `dt = clock.tick(FPS)/1000` gives us the opposite
+                tt += dt
+                ti += 1
+                if ratelimit:
+                    clock.tick(fps)
+
+                with timer.phase('display'):
+                    pygame.display.update()
 
-        #### Update frames
-        # fixed dt = visual inconsistency but simulated consistency
-        # setting dt as `dt = clock.tick(FPS)/1000` gives us the opposite
-        tt += dt
-        ti += 1
-        if ratelimit:
-            clock.tick(fps)
-            
-        pygame.display.update()
-    
     # broadcast throughput
-    sum_recv = sum(cum_tot_recv)
-    sum_sent = sum(cum_tot_sent)
     throughput = sum_recv/(sum_sent*(N-1))
     if simplify_render < 2:
         print("Broadcast throughput:")
         print(f"{sum_recv} recv/({sum_sent} sent*(N-1)) = {100*throughput:.1f}%")
+    _print_profile(timer)
 
     return throughput
 
 
+def _draw_profile(screen, font, timer):
+    # Phase timings in the bottom left corner, if profiling
+    if not timer.enabled:
+        return
+    lines = len(timer.averages())
+    timer.draw(screen, font, corner=(4, screen.get_height() - 14*lines - 4))
+
+
+def _print_profile(timer):
+    if timer.enabled:
+        print("Time per phase:")
+        print(timer.report())
+
+
+def _draw_network(screen, font, M, D, Ar, M_to_draw, Ar_to_draw, dt):
+    """Draw the M, A' and D visualizations.
+
+    M and A' fade out over time, so the faded matrices are passed
+    in and returned for the next frame.
+
+    :return: M_to_draw and Ar_to_draw for the next frame
+    :rtype: Tuple[np.ndarray, np.ndarray]
+    """
+    N, K = M.shape
+    width, height = screen.get_size()
+
+    #### Draw metadata
+    # Draw M and Ar here
+    fps_text = font.render('M and A\' visualization', S16.lime)
+    screen.blit(fps_text[0], (4,4))
+
+    # Draw M graph
+    M_to_draw = np.clip(M + (1-dt*6) * M_to_draw, 0, 1)
+    draw_M(corner=(4, 16), M=M_to_draw.T, screen=screen, width=3)
+
+    # Draw Ar graph
+    Ar_to_draw = np.clip(
+        _normalize_safe(Ar) + (1-dt*6) * Ar_to_draw,
+        0, 1
+    )
+    draw_M(corner=(13 + K*4, 16), M=Ar_to_draw.T, C1=S16.cyan, screen=screen, width=3)
+
+    # Draw D graph text
+    D_corner=(width - N*3 - 4, height-N*3 - 4)
+    fps_text = font.render('D visualization', S16.orange)
+    screen.blit(fps_text[0], (D_corner[0], D_corner[1] - 16))
+
+    # Draw D graph
+    D = _normalize_safe(D)**(1/4)
+    draw_M(
+        corner=D_corner,
+        M=D, screen=screen, width=3, border=0, C1=S16.orange
+    )
+    return M_to_draw, Ar_to_draw
+
+
+@dataclass
+class _Snapshot:
+    '''
+    Simulation state after one fixed timestep, for the renderer.
+    '''
+    frame: int
+    history: np.ndarray
+    M: np.ndarray
+    D: np.ndarray
+    Ar: np.ndarray
+
+
+class _LatestSnapshot:
+    """Single-slot mailbox: the simulation publishes, the renderer takes the newest.
+
+    Snapshots that were never taken are dropped.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._snapshot = None
+
+    def publish(self, snapshot: _Snapshot):
+        with self._lock:
+            self._snapshot = snapshot
+
+    def take(self):
+        with self._lock:
+            snapshot, self._snapshot = self._snapshot, None
+        return snapshot
+
+
+def _simulate_fixed_step(swarm, rng, K, dt, total_time, latest, stop, ratelimit, totals, writer=None, timer=None):
+    # Worker thread: advance physics and network at a fixed dt, publish every frame
+    if timer is None:
+        timer = PhaseTimer(enabled=False)
+    start = time.perf_counter()
+    tt = 0 # timestep
+    ti = 0 # time index
+    while tt < total_time and not stop.is_set():
+        with timer.phase('update'):
+            swarm.update(dt=dt)
+        with timer.phase('physical'):
+            tot_sent, tot_recv, M, D, _, Ar = example_physical_simulation(swarm.coordinates, dt, K, rng=rng)
+        totals[0] += tot_sent
+        totals[1] += tot_recv
+        if writer is not None:
+            writer.record(tt + dt, tot_sent, tot_recv, M, D, Ar)
+        latest.publish(_Snapshot(frame=ti, history=swarm.history(), M=M, D=D, Ar=Ar))
+
+        tt += dt
+        ti += 1
+        if ratelimit:
+            # don't run ahead of real time
+            ahead = tt - (time.perf_counter() - start)
+            if ahead > 0:
+                time.sleep(ahead)
+
+
+def _main_threaded(swarm, screen, font, clock, rng, K, dt, total_time, transform, simplify_render, ratelimit, writer=None, timer=None):
+    """Run the simulation on a worker thread and render its latest snapshot.
+
+    The worker advances at a fixed dt, so results are the same as the
+    lockstep loop. The renderer runs at display rate and skips any
+    frames the worker produced in between.
+
+    :return: Total messages sent and received, or None if the window was closed
+    :rtype: Tuple[int, int] or None
+    """
+    N = swarm.N
+    if timer is None:
+        timer = PhaseTimer(enabled=False)
+    latest = _LatestSnapshot()
+    stop = threading.Event()
+    totals = [0, 0]
+    errors = []
+
+    def worker():
+        try:
+            _simulate_fixed_step(swarm, rng, K, dt, total_time, latest, stop, ratelimit, totals, writer, timer)
+        except BaseException as err:
+            errors.append(err)
+
+    thread = threading.Thread(target=worker, name="simulation", daemon=True)
+    thread.start()
+
+    M_to_draw = np.zeros((N,K))
+    Ar_to_draw = np.zeros((N,K))
+    snapshot = None
+    while thread.is_alive():
+        #### Handle controls
+        with timer.phase('events'):
+            events = pygame.event.get()
+        for ev in events:
+            if ev.type == pygame.QUIT:
+                stop.set()
+                thread.join()
+                return None
+
+        #### Draw the newest frame, if there is one
+        newest = latest.take()
+        if newest is not None:
+            snapshot = newest
+            screen.fill(S16.black)
+            with timer.phase('draw'):
+                draw_swarm(screen, snapshot.history, tail = not simplify_render, transform = transform)
+            if not simplify_render:
+                with timer.phase('draw_M'):
+                    M_to_draw, Ar_to_draw = _draw_network(
+                        screen, font, snapshot.M, snapshot.D, snapshot.Ar, M_to_draw, Ar_to_draw, dt
+                    )
+            _draw_profile(screen, font, timer)
+            with timer.phase('display'):
+                pygame.display.update()
+
+        # display rate, independent of the simulation
+        clock.tick(1/dt)
+
+    thread.join()
+    if errors:
+        raise errors[0]
+    return totals[0], totals[1]
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="")
@@ -215,6 +422,36 @@ if __name__ == '__main__':
         help="Render faster than FPS",
         action="store_true"
     )
+    parser.add_argument(
+        "--threaded",
+        default=False,
+        help="Simulate on a separate thread, rendering only the latest frame",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--metrics",
+        default=[None],
+        help="File to stream per-frame metrics to, as .npy",
+        type=str, nargs=1
+    )
+    parser.add_argument(
+        "--metrics-per-node",
+        default=False,
+        help="Also record per-node counts in the metrics file",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--profile",
+        default=False,
+        help="Show the time spent in each phase of the loop, and print it on exit",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--seed",
+        default=[None],
+        help="Seed for a reproducible run",
+        type=int, nargs=1
+    )
 
     args = parser.parse_args()
 
@@ -227,5 +464,10 @@ if __name__ == '__main__':
         font_fn = args.font[0],
         total_time=args.totaltime[0],
         simplify_render=args.simple,
-        ratelimit = not args.noratelimit
+        ratelimit = not args.noratelimit,
+        seed = args.seed[0],
+        threaded = args.threaded,
+        metrics = args.metrics[0],
+        metrics_per_node = args.metrics_per_node,
+        profile = args.profile
     )
\ No newline at end of file
@@ -0,0 +1,166 @@
+"""Per-frame metrics, streamed to disk as the run proceeds.
+
+Records are appended to a .npy file of a structured dtype, so long runs
+use constant memory and the file loads with np.load (or read_metrics,
+memory-mapped) for throughput-over-time analysis.
+"""
+import numpy as np
+
+# Room in the header for any record count, so it can be patched in place
+_MAX_FRAMES = np.iinfo(np.int64).max
+
+
+def reception_counts(D, M, Ar):
+    """Messages received per channel and per receiving node.
+
+    Same reception rule as kernels.count_receptions, over
+    the active (transmitter, channel) pairs of M only.
+
+    :param D: Inverse-square distance matrix, shape (N, N)
+    :type D: np.ndarray
+    :param M: Message matrix, shape (N, K)
+    :type M: np.ndarray
+    :param Ar: Loudness per node per channel, shape (N, K)
+    :type Ar: np.ndarray
+    :return: Receptions per channel (shape (K,)) and per node (shape (N,))
+    :rtype: Tuple[np.ndarray, np.ndarray]
+    """
+    N, K = np.shape(M)
+    jj, kk = np.nonzero(M)
+    loudness = D[:, jj]
+    total = Ar[:, kk]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        received = (total != 0) & (loudness / total > 1/2)
+    per_channel = np.bincount(kk, weights=received.sum(axis=0), minlength=K)
+    per_node = received.sum(axis=1)
+    return per_channel.astype(int), per_node
+
+
+class MetricsWriter:
+    """Append-only .npy file of per-frame records.
+
+    Each record has the simulated time and the messages sent and received.
+    With K > 0, it also has messages sent and received per channel,
+    and with N > 0, messages sent and received per node.
+
+    Records are buffered and written in blocks. The header is written
+    up front with room for any length, and patched with the final
+    record count on close.
+
+    :param path: File to write, conventionally ending in .npy
+    :type path: str
+    :param K: Number of channels to record, defaults to 0 (no per-channel columns)
+    :type K: int, optional
+    :param N: Number of nodes to record, defaults to 0 (no per-node columns)
+    :type N: int, optional
+    :param buffer: Records kept in memory between writes, defaults to 256
+    :type buffer: int, optional
+    """
+    def __init__(self, path, K: int = 0, N: int = 0, buffer: int = 256):
+        if buffer < 1:
+            raise ValueError(f"buffer must be at least 1, got {buffer}")
+        fields = [('time', '<f8'), ('sent', '<f8'), ('received', '<f8')]
+        if K:
+            fields += [('channel_sent', '<i4', (K,)), ('channel_received', '<i4', (K,))]
+        if N:
+            fields += [('node_sent', '<i4', (N,)), ('node_received', '<i4', (N,))]
+        self.dtype = np.dtype(fields)
+        self.K = K
+        self.N = N
+        self.path = path
+        self.frames = 0
+
+        self._buffer = np.zeros(buffer, dtype=self.dtype)
+        self._buffered = 0
+        self._file = open(path, 'wb')
+        self._header_length = len(self._header(_MAX_FRAMES))
+        self._file.write(self._header(0))
+
+    def _header(self, frames):
+        # .npy format version 1.0, padded to a fixed length so it can be rewritten
+        header = repr({
+            'descr': np.lib.format.dtype_to_descr(self.dtype),
+            'fortran_order': False,
+            'shape': (frames,),
+        })
+        length = getattr(self, '_header_length', None)
+        if length is None:
+            # magic (6) + version (2) + header length (2) + header + newline, to 64 bytes
+            length = -(-(10 + len(header) + 1) // 64) * 64
+        header = header.ljust(length - 10 - 1) + '\n'
+        return b'\x93NUMPY\x01\x00' + np.uint16(len(header)).tobytes() + header.encode('latin1')
+
+    def record(self, time, sent, received, M=None, D=None, Ar=None):
+        """Append one frame.
+
+        Per-channel and per-node sent counts come from M, and received
+        counts from D, M and Ar (see reception_counts). Columns whose
+        inputs are not given are left as zero.
+
+        :param time: Simulated time of the frame
+        :type time: float
+        :param sent: Messages sent this frame
+        :type sent: float
+        :param received: Messages received this frame
+        :type received: float
+        :param M: Message matrix, shape (N, K), defaults to None
+        :type M: np.ndarray, optional
+        :param D: Inverse-square distance matrix, shape (N, N), defaults to None
+        :type D: np.ndarray, optional
+        :param Ar: Loudness per node per channel, shape (N, K), defaults to None
+        :type Ar: np.ndarray, optional
+        """
+        row = self._buffer[self._buffered]
+        row['time'] = time
+        row['sent'] = sent
+        row['received'] = received
+        if self.K or self.N:
+            received_by = None
+            if M is not None and D is not None and Ar is not None:
+                received_by = reception_counts(D, M, Ar)
+            if self.K:
+                row['channel_sent'] = 0 if M is None else np.sum(M, axis=0)
+                row['channel_received'] = 0 if received_by is None else received_by[0]
+            if self.N:
+                row['node_sent'] = 0 if M is None else np.sum(M, axis=1)
+                row['node_received'] = 0 if received_by is None else received_by[1]
+
+        self._buffered += 1
+        self.frames += 1
+        if self._buffered == len(self._buffer):
+            self.flush()
+
+    def flush(self):
+        """Write buffered records to the file."""
+        self._file.write(self._buffer[:self._buffered].tobytes())
+        self._buffer[:self._buffered] = 0
+        self._buffered = 0
+        self._file.flush()
+
+    def close(self):
+        """Flush, and write the final record count to the header."""
+        if self._file.closed:
+            return
+        self.flush()
+        self._file.seek(0)
+        self._file.write(self._header(self.frames))
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_metrics(path):
+    """Load a metrics file, memory-mapped.
+
+    E.g. read_metrics(path)['received'].cumsum() for cumulative receptions.
+
+    :param path: File written by MetricsWriter
+    :type path: str
+    :return: One record per frame
+    :rtype: np.memmap
+    """
+    return np.load(path, mmap_mode='r')
@@ -0,0 +1,874 @@
+"""Alternative physical layers.
+
+These take the same inputs as toolkit.example_physical_simulation,
+trading exactness or memory for speed when N gets large.
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Tuple
+
+import numpy as np
+
+from kernels import inverse_square_distances, inverse_square_distances_rows, inverse_square_distances_columns, count_receptions, count_receptions_numpy
+from toolkit import example_physical_simulation, broadcast_throughput, as_rng
+
+
+@dataclass
+class CSRMatrix:
+    '''
+    Minimal compressed-sparse-row matrix, as plain numpy arrays.
+
+    Row i stores data[indptr[i]:indptr[i+1]]
+    at the columns indices[indptr[i]:indptr[i+1]].
+    '''
+    indptr: np.ndarray
+    indices: np.ndarray
+    data: np.ndarray
+    shape: Tuple[int, int]
+
+    @property
+    def nnz(self):
+        return len(self.data)
+
+    def rows(self):
+        """Row index of every stored entry."""
+        return np.repeat(np.arange(self.shape[0]), np.diff(self.indptr))
+
+    def toarray(self):
+        dense = np.zeros(self.shape)
+        dense[self.rows(), self.indices] = self.data
+        return dense
+
+
+def _grid_cells(coordinates, cell_size: float):
+    # Integer (column, row) of the grid cell holding each node, starting at 0
+    cells = np.floor(coordinates / cell_size).astype(np.int64)
+    return cells - cells.min(axis=0)
+
+
+def grid_neighbor_pairs(coordinates, cell_size: float):
+    """Find all pairs of nodes in neighboring cells of a uniform grid.
+
+    Returns every ordered pair (i, j), i != j, where j lies in the 3x3 block
+    of cells around i. This includes every pair closer than cell_size.
+
+    :param coordinates: Array of x, y coordinates, shape (N, 2)
+    :type coordinates: np.ndarray
+    :param cell_size: Side length of a grid cell
+    :type cell_size: float
+    :return: Row (i) and column (j) indices, sorted by row then column
+    :rtype: Tuple[np.ndarray, np.ndarray]
+    """
+    N = len(coordinates)
+    if N == 0:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+
+    cells = _grid_cells(coordinates, cell_size)
+    # +1 margin on each side so that neighbor keys never alias
+    width = cells[:, 1].max() + 3
+    keys = (cells[:, 0] + 1) * width + (cells[:, 1] + 1)
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+
+    rows, cols = [], []
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            neighbor = keys + dx * width + dy
+            start = np.searchsorted(sorted_keys, neighbor, side='left')
+            counts = np.searchsorted(sorted_keys, neighbor, side='right') - start
+            # expand each [start, start+count) range into indices
+            offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+            rows.append(np.repeat(np.arange(N), counts))
+            cols.append(order[np.repeat(start, counts) + offsets])
+
+    rows = np.concatenate(rows)
+    cols = np.concatenate(cols)
+    keep = rows != cols
+    rows, cols = rows[keep], cols[keep]
+    order = np.lexsort((cols, rows))
+    return rows[order], cols[order]
+
+
+def sparse_inverse_square_distances(coordinates, cutoff: float):
+    """Sparse D, keeping only the pairs found by grid_neighbor_pairs.
+
+    Every pair closer than cutoff is stored exactly, as are some
+    pairs up to 2*sqrt(2)*cutoff apart. The rest are left out.
+
+    :param coordinates: Array of x, y coordinates, shape (N, 2)
+    :type coordinates: np.ndarray
+    :param cutoff: Radius within which D is exact, also the grid cell size
+    :type cutoff: float
+    :return: D in CSR form, shape (N, N)
+    :rtype: CSRMatrix
+    """
+    coordinates = np.asarray(coordinates, dtype=float)
+    N = len(coordinates)
+    rows, cols = grid_neighbor_pairs(coordinates, cutoff)
+    delta = coordinates[rows] - coordinates[cols]
+    data = 1 / (delta[:, 0]**2 + delta[:, 1]**2)
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=N))])
+    return CSRMatrix(indptr=indptr, indices=cols, data=data, shape=(N, N))
+
+
+def _cell_sums(cell_of, num_cells, coordinates, M):
+    # Per cell: centroid of its nodes, and transmitters and their centroid per channel
+    order = np.argsort(cell_of, kind='stable')
+    starts = np.searchsorted(cell_of[order], np.arange(num_cells))
+    reduce = lambda values: np.add.reduceat(values[order], starts, axis=0)
+
+    nodes = np.bincount(cell_of, minlength=num_cells)
+    receivers_xy = reduce(coordinates) / nodes[:, None]
+    size = reduce(M).astype(float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        transmitters_xy = np.stack([
+            reduce(M * coordinates[:, dd, None]) / size for dd in (0, 1)
+        ], axis=-1)
+    return receivers_xy, size, transmitters_xy
+
+
+def _far_field(coordinates, M, cell_size: float):
+    """Approximate loudness from transmitters outside each node's 3x3 block of cells.
+
+    Cells are merged 2x2 into coarser levels, as in a quadtree. At each level,
+    a cell hears the cells that are not its neighbors but whose parents are its
+    parent's neighbors, at most 27 of them, so together the levels cover every
+    transmitter outside the 3x3 block exactly once. Transmitters are lumped
+    together per (cell, channel) at their centroid, and heard at the centroid
+    of the receiving cell one level finer. So the cost is bounded by the number
+    of occupied cells, not the number of transmissions: O(cells * K) per level.
+
+    :param coordinates: Array of x, y coordinates, shape (N, 2)
+    :type coordinates: np.ndarray
+    :param M: Message matrix, shape (N, K)
+    :type M: np.ndarray
+    :param cell_size: Side length of a grid cell at the finest level
+    :type cell_size: float
+    :return: Far-field loudness per node per channel, shape (N, K)
+    :rtype: np.ndarray
+    """
+    N, K = M.shape
+    cells = _grid_cells(coordinates, cell_size)
+    width = cells[:, 1].max() + 1
+
+    def level_sums(level):
+        # cell keys, the cell of each node, and _cell_sums, at this level
+        level_cells = cells >> level
+        keys, cell_of = np.unique(level_cells[:, 0] * width + level_cells[:, 1], return_inverse=True)
+        return (keys, cell_of) + _cell_sums(cell_of, len(keys), coordinates, M)
+
+    Ar = np.zeros((N, K))
+    receivers = sources = level_sums(0)
+    level = 0
+    while True:
+        keys, _, _, size, transmitters_xy = sources
+        receiver_keys, receiver_of, receivers_xy, _, _ = receivers
+        # receiving cells, in the cell coordinates of this level
+        receiver_cells = np.stack([receiver_keys // width, receiver_keys % width], axis=1) >> min(level, 1)
+
+        # children of the parent's 3x3 neighbors, that aren't the receiver's neighbors
+        Ar_cells = np.zeros((len(receiver_keys), K))
+        corner = (receiver_cells // 2 - 1) * 2
+        for dx in range(6):
+            for dy in range(6):
+                neighbor_cells = corner + (dx, dy)
+                neighbor_keys = neighbor_cells[:, 0] * width + neighbor_cells[:, 1]
+                neighbor = np.minimum(np.searchsorted(keys, neighbor_keys), len(keys) - 1)
+                found = (
+                    (np.abs(neighbor_cells - receiver_cells) > 1).any(axis=1)
+                    & (neighbor_cells >= 0).all(axis=1) & (neighbor_cells[:, 1] < width)
+                    & (keys[neighbor] == neighbor_keys)
+                )
+                rows, neighbor = np.nonzero(found)[0], neighbor[found]
+                delta = receivers_xy[rows, None, :] - transmitters_xy[neighbor]
+                distance_sq = delta[..., 0]**2 + delta[..., 1]**2
+                Ar_cells[rows] += np.divide(
+                    size[neighbor], distance_sq, out=np.zeros(distance_sq.shape), where=size[neighbor] > 0
+                )
+        Ar += Ar_cells[receiver_of]
+
+        # once every parent neighbors every other, nothing is left to hear
+        if (cells >> level).max() // 2 <= 1:
+            return Ar
+        level += 1
+        receivers, sources = sources, level_sums(level)
+
+
+def sparse_physical_simulation(
+    coordinates,
+    dt: float = 1/60,
+    K: int = 10,
+    cutoff: float = 50.0,
+    far_field: bool = True,
+    M = None,
+    rng = None
+):
+    """Approximate physical layer that only computes D within a cutoff radius.
+
+    Pairs are found with a uniform grid of cell size cutoff, and D is stored
+    sparsely. Transmitters further away only add to Ar, through a cheap
+    far-field term, and are never received from.
+    See cutoff_throughput_error for the error against the exact path.
+
+    :param coordinates: Array of x, y coordinates, shape (N, 2)
+    :type coordinates: np.ndarray
+    :param dt: Timestep, defaults to 1/60
+    :type dt: float, optional
+    :param K: Number of channels, defaults to 10
+    :type K: int, optional
+    :param cutoff: Radius within which D is exact, defaults to 50.0
+    :type cutoff: float, optional
+    :param far_field: Add the far-field approximation to Ar, defaults to True
+    :type far_field: bool, optional
+    :param M: Message matrix to use instead of sampling one, defaults to None
+    :type M: np.ndarray, optional
+    :param rng: Seed or generator to sample M with, defaults to None (see as_rng)
+    :type rng: int or np.random.Generator, optional
+
+    :returns: As example_physical_simulation: total messages sent,
+        total messages received, M, the sparse D (as a CSRMatrix), None (A),
+        and Ar.
+    """
+    coordinates = np.reshape(np.asarray(coordinates, dtype=float), (-1, 2))
+    N = len(coordinates)
+
+    if M is None:
+        M = (as_rng(rng).random((N, K)) < dt).astype(int)
+
+    D = sparse_inverse_square_distances(coordinates, cutoff)
+    rows = D.rows()
+
+    # near-field loudness, only over stored pairs whose column transmits
+    pair, kk = np.nonzero(M[D.indices])
+    receivers = rows[pair]
+    # float even when no pair transmits, where bincount gives ints
+    Ar = np.bincount(
+        receivers * K + kk, weights=D.data[pair], minlength=N*K
+    ).reshape(N, K).astype(float)
+    if far_field and N > 0:
+        Ar += _far_field(coordinates, M, cutoff)
+
+    total = Ar[receivers, kk]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        received = (total != 0) & (D.data[pair] / total > 1/2)
+
+    return np.sum(M), int(np.count_nonzero(received)), M, D, None, Ar
+
+
+def _row_blocks(N: int, block: int):
+    # (start, stop) of each block of receiver rows
+    return [(start, min(start + block, N)) for start in range(0, N, block)]
+
+
+def _physical_rows(coordinates, M, start, stop, D=None, Ar=None):
+    # Receivers start:stop: build their rows of D and Ar, count what they receive,
+    # and keep the rows only if D or Ar are given to fill
+    D_rows = inverse_square_distances_rows(coordinates, start, stop)
+    Ar_rows = D_rows @ M
+    if D is not None:
+        D[start:stop] = D_rows
+    if Ar is not None:
+        Ar[start:stop] = Ar_rows
+    return count_receptions_numpy(D_rows, M, Ar_rows)
+
+
+def _received_by_rows(coordinates, M, block, workers, D=None, Ar=None):
+    # _physical_rows over all blocks of receivers, serially or on a thread pool
+    blocks = _row_blocks(len(coordinates), block)
+    if workers == 1 or len(blocks) <= 1:
+        received = [_physical_rows(coordinates, M, start, stop, D, Ar) for start, stop in blocks]
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            received = list(pool.map(
+                lambda rows: _physical_rows(coordinates, M, *rows, D, Ar), blocks
+            ))
+    return int(sum(received))
+
+
+def parallel_physical_simulation(
+    coordinates,
+    dt: float = 1/60,
+    K: int = 10,
+    workers: int = None,
+    block: int = None,
+    M = None,
+    rng = None
+):
+    """example_physical_simulation, split into blocks of receiver rows on a thread pool.
+
+    Each block builds its rows of D and Ar and counts its receptions,
+    and the counts are summed. NumPy releases the GIL in the array
+    operations and the BLAS product, so the blocks run in parallel.
+
+    :param coordinates: Array of x, y coordinates, shape (N, 2)
+    :type coordinates: np.ndarray
+    :param dt: Timestep, defaults to 1/60
+    :type dt: float, optional
+    :param K: Number of channels, defaults to 10
+    :type K: int, optional
+    :param workers: Number of threads, defaults to None (one per CPU)
+    :type workers: int, optional
+    :param block: Receiver rows per block, defaults to None (four blocks per thread)
+    :type block: int, optional
+    :param M: Message matrix to use instead of sampling one, defaults to None
+    :type M: np.ndarray, optional
+    :param rng: Seed or generator to sample M with, defaults to None (see as_rng)
+    :type rng: int or np.random.Generator, optional
+
+    :returns: As example_physical_simulation: total messages sent,
+        total messages received, M, D, A (always None), and Ar.
+    """
+    coordinates = np.reshape(np.asarray(coordinates, dtype=float), (-1, 2))
+    N = len(coordinates)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if block is None:
+        block = max(1, -(-N // (4*workers)))
+
+    if M is None:
+        M = (as_rng(rng).random((N, K)) < dt).astype(int)
+
+    D = np.empty((N, N))
+    Ar = np.empty((N, K))
+    received = _received_by_rows(coordinates, M, block, workers, D, Ar)
+    return np.sum(M), received, M, D, None, Ar
+
+
+def chunked_physical_simulation(
+    coordinates,
+    dt: float = 1/60,
+    K: int = 10,
+    chunk: int = 1024,
+    return_Ar: bool = False,
+    workers: int = 1,
+    M = None,
+    rng = None
+):
+    """example_physical_simulation in bounded memory, for very large N.
+
+    Receivers are processed in chunks: each chunk's rows of D and Ar are
+    built, used to count its receptions, and discarded. So peak memory is
+    O(chunk * N), rather than O(N^2) for D (or O(N^2 K) for A).
+
+    :param coordinates: Array of x, y coordinates, shape (N, 2)
+    :type coordinates: np.ndarray
+    :param dt: Timestep, defaults to 1/60
+    :type dt: float, optional
+    :param K: Number of channels, defaults to 10
+    :type K: int, optional
+    :param chunk: Receivers per chunk, defaults to 1024
+    :type chunk: int, optional
+    :param return_Ar: Keep and return Ar, shape (N, K), defaults to False
+    :type return_Ar: bool, optional
+    :param workers: Number of threads, each holding one chunk at a time, defaults to 1
+    :type workers: int, optional
+    :param M: Message matrix to use instead of sampling one, defaults to None
+    :type M: np.ndarray, optional
+    :param rng: Seed or generator to sample M with, defaults to None (see as_rng)
+    :type rng: int or np.random.Generator, optional
+
+    :returns: As example_physical_simulation: total messages sent,
+        total messages received, M, D (always None), A (always None),
+        and Ar (None unless return_Ar is set).
+    """
+    if chunk < 1:
+        raise ValueError(f"chunk must be at least 1, got {chunk}")
+    coordinates = np.reshape(np.asarray(coordinates, dtype=float), (-1, 2))
+    N = len(coordinates)
+
+    if M is None:
+        M = (as_rng(rng).random((N, K)) < dt).astype(int)
+
+    Ar = np.empty((N, K)) if return_Ar else None
+    received = _received_by_rows(coordinates, M, chunk, workers, Ar=Ar)
+    return np.sum(M), received, M, None, None, Ar
+
+
+def event_physical_simulation(
+    coordinates,
+    dt: float = 1/60,
+    K: int = 10,
+    M = None,
+    rng = None
+):
+    """example_physical_simulation, working only from the transmissions.
+
+    At low message rates M is almost all zeros, so instead of D @ M and a
+    scan over all of M, only the active (transmitter, channel) pairs are
+    used. The columns of D to those transmitters are built, summed per
+    channel into Ar, and checked for receptions. Cost is O(N * messages sent),
+    and a frame without transmissions costs little more than sampling M.
+
+    :param coordinates: Array of x, y coordinates, shape (N, 2)
+    :type coordinates: np.ndarray
+    :param dt: Timestep, defaults to 1/60
+    :type dt: float, optional
+    :param K: Number of channels, defaults to 10
+    :type K: int, optional
+    :param M: Message matrix to use instead of sampling one, defaults to None
+    :type M: np.ndarray, optional
+    :param rng: Seed or generator to sample M with, defaults to None (see as_rng)
+    :type rng: int or np.random.Generator, optional
+
+    :returns: As example_physical_simulation: total messages sent,
+        total messages received, M, D (always None), A (always None),
+        and Ar, which is zero on channels without transmissions.
+    """
+    coordinates = np.reshape(np.asarray(coordinates, dtype=float), (-1, 2))
+    N = len(coordinates)
+
+    if M is None:
+        M = (as_rng(rng).random((N, K)) < dt).astype(int)
+
+    Ar = np.zeros((N, K))
+    jj, kk = np.nonzero(M)
+    if len(jj) == 0:
+        return np.sum(M), 0, M, None, None, Ar
+
+    # D[:, jj], one column per transmission, summed into its channel
+    loudness = inverse_square_distances_columns(coordinates, jj)
+    channels = np.zeros((len(kk), K))
+    channels[np.arange(len(kk)), kk] = 1
+    Ar = loudness @ channels
+
+    total = Ar[:, kk]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        received = (total != 0) & (loudness / total > 1/2)
+    return np.sum(M), int(np.count_nonzero(received)), M, None, None, Ar
+
+
+def cutoff_throughput_error(
+    coordinates,
+    dt: float = 1/60,
+    K: int = 10,
+    cutoff: float = 50.0,
+    far_field: bool = True,
+    trials: int = 10,
+    rng = None
+):
+    """Maximum throughput error of sparse_physical_simulation against
+    the exact dense example_physical_simulation.
+
+    Both paths see the same M in each trial.
+
+    :param coordinates: Array of x, y coordinates, shape (N, 2)
+    :type coordinates: np.ndarray
+    :param dt: Timestep, defaults to 1/60
+    :type dt: float, optional
+    :param K: Number of channels, defaults to 10
+    :type K: int, optional
+    :param cutoff: Radius within which D is exact, defaults to 50.0
+    :type cutoff: float, optional
+    :param far_field: Add the far-field approximation to Ar, defaults to True
+    :type far_field: bool, optional
+    :param trials: Number of message matrices to try, defaults to 10
+    :type trials: int, optional
+    :param rng: Seed or generator to sample M with, defaults to None (see as_rng)
+    :type rng: int or np.random.Generator, optional
+    :return: Largest absolute difference in throughput over the trials
+    :rtype: float
+    """
+    N = len(coordinates)
+    rng = as_rng(rng)
+    errors = []
+    for _ in range(trials):
+        sent, exact, M, _, _, _ = example_physical_simulation(coordinates, dt, K, rng=rng)
+        _, approx, _, _, _, _ = sparse_physical_simulation(
+            coordinates, dt, K, cutoff, far_field, M=M
+        )
+        error = abs(broadcast_throughput(approx, sent, N) - broadcast_throughput(exact, sent, N))
+        # frames where nothing was sent say nothing about the error
+        if not np.isnan(error):
+            errors.append(error)
+    return max(errors, default=0.0)
+
+
+@dataclass
+class IncrementalStats:
+    '''
+    How much of D and Ar one IncrementalPhysicalLayer step recomputed.
+    '''
+    nodes_moved: int
+    entries_recomputed: int
+    fraction_recomputed: float
+    Ar_update: str
+
+
+class IncrementalPhysicalLayer:
+    def __init__(self, tolerance: float = 0.0, full_rebuild_fraction: float = 1/3):
+        """Physical layer that keeps D between frames.
+
+        Only the rows and columns of nodes that moved more than tolerance
+        since their entries were last computed are rebuilt. If more than
+        full_rebuild_fraction of the nodes moved, as with tolerance 0 or
+        one below a frame's motion, D is rebuilt whole instead, which is
+        then cheaper than scattering its rows and columns.
+
+        Ar is updated from the previous step's, by the rebuilt rows and
+        columns of D and by the entries of M that changed. A fresh M at
+        rate dt changes few entries, so this beats Ar = D @ M unless more
+        than a tenth of M changed, or D was rebuilt whole, when Ar = D @ M.
+        Updated entries of Ar agree with D @ M to rounding. With tolerance 0
+        and moving nodes, the results equal example_physical_simulation.
+
+        Call step() once per frame, in place of example_physical_simulation.
+        stats describes the last step.
+
+        :param tolerance: Distance a node may move before its entries of D
+            are recomputed, defaults to 0.0
+        :type tolerance: float, optional
+        :param full_rebuild_fraction: Rebuild all of D once more than this
+            fraction of the nodes moved, defaults to 1/3
+        :type full_rebuild_fraction: float, optional
+        """
+        self.tolerance = tolerance
+        self.full_rebuild_fraction = full_rebuild_fraction
+        self.D = None
+        self.Ar = None
+        self.stats = None
+        # positions that the current entries of D were computed from
+        self._reference = None
+        self._M = None
+
+    def _rebuild(self, moved):
+        # Recompute rows and columns `moved` of D; return the old columns
+        reference = self._reference
+        delta = reference[moved][:, None, :] - reference[None, :, :]
+        distance_sq = delta[..., 0]**2 + delta[..., 1]**2
+        distance_sq[np.arange(len(moved)), moved] = np.inf
+        rows = 1 / distance_sq
+
+        old_columns = self.D[:, moved].copy()
+        self.D[moved, :] = rows
+        self.D[:, moved] = rows.T
+        return old_columns
+
+    def step(
+        self,
+        coordinates,
+        dt: float = 1/60,
+        K: int = 10,
+        M = None,
+        rng = None
+    ):
+        """Advance the physical layer by one frame.
+
+        :param coordinates: Array of x, y coordinates, shape (N, 2)
+        :type coordinates: np.ndarray
+        :param dt: Timestep, defaults to 1/60
+        :type dt: float, optional
+        :param K: Number of channels, defaults to 10
+        :type K: int, optional
+        :param M: Message matrix to use instead of sampling one, defaults to None
+        :type M: np.ndarray, optional
+        :param rng: Seed or generator to sample M with, defaults to None (see as_rng)
+        :type rng: int or np.random.Generator, optional
+
+        :returns: Same as example_physical_simulation; A is always None.
+            D and Ar are this layer's own arrays, which the next step may update in place.
+        """
+        coordinates = np.reshape(np.asarray(coordinates, dtype=float), (-1, 2))
+        N = len(coordinates)
+
+        if M is None:
+            M = (as_rng(rng).random((N, K)) < dt).astype(int)
+
+        if self.D is None or self.D.shape != (N, N) or self._M is None or self._M.shape != M.shape:
+            # first frame, or the network changed size: start over
+            moved = np.arange(N)
+        else:
+            displacement = np.linalg.norm(coordinates - self._reference, axis=1)
+            moved = np.nonzero(displacement > self.tolerance)[0]
+            changed = np.nonzero(M != self._M)
+
+        if len(moved) == N or len(moved) > self.full_rebuild_fraction * N:
+            self._reference = coordinates.copy()
+            self.D = inverse_square_distances(coordinates)
+            entries = N * N
+            rebuilt = True
+        else:
+            self._reference[moved] = coordinates[moved]
+            entries = len(moved) * (2*N - len(moved))
+            old_columns = self._rebuild(moved) if len(moved) else None
+            rebuilt = False
+
+        if rebuilt or len(changed[0]) > M.size / 10:
+            self.Ar = self.D @ M
+            Ar_update = 'full'
+        elif len(moved) or len(changed[0]):
+            if len(moved):
+                # D changed only in rows and columns `moved`, at the previous M
+                self.Ar += (self.D[:, moved] - old_columns) @ self._M[moved]
+                self.Ar[moved] = self.D[moved] @ self._M
+            # then the changed entries of M, at the new D; rows of D, as it is symmetric
+            jj, kk = changed
+            sign = (M - self._M)[jj, kk]
+            for k in np.unique(kk):
+                on_k = kk == k
+                self.Ar[:, k] += sign[on_k] @ self.D[jj[on_k]]
+            Ar_update = 'low-rank'
+        else:
+            Ar_update = 'none'
+
+        self._M = M.copy()
+        self.stats = IncrementalStats(
+            nodes_moved = len(moved),
+            entries_recomputed = entries,
+            fraction_recomputed = entries / (N * N) if N else 0.0,
+            Ar_update = Ar_update,
+        )
+
+        total_messages_sent = np.sum(M)
+        total_message_received = count_receptions(self.D, M, self.Ar)
+        return total_messages_sent, total_message_received, M, self.D, None, self.Ar
+
+
+@dataclass
+class StalenessStats:
+    '''
+    How often a CachedPhysicalLayer has rebuilt D, over all its steps.
+    '''
+    frames: int = 0
+    rebuilds: int = 0
+    # frames since D was built, and how far any node has moved since, as of the last step
+    age: int = 0
+    max_displacement: float = 0.0
+
+    @property
+    def rebuild_fraction(self):
+        return self.rebuilds / self.frames if self.frames else 0.0
+
+
+class CachedPhysicalLayer:
+    def __init__(self, refresh_every: int = 10, max_displacement: float = None):
+        """Physical layer that reuses a stale D, within a staleness budget.
+
+        D is rebuilt from the current positions every refresh_every frames,
+        or sooner once any node has moved more than max_displacement since
+        the last build. In between, the cached D is used as is; M and Ar
+        are still computed every frame. With refresh_every=1 the results
+        equal example_physical_simulation. See simulation.compare_physical_layers
+        for the throughput error a budget introduces.
+
+        Call step() once per frame, in place of example_physical_simulation.
+        stats counts the rebuilds so far.
+
+        :param refresh_every: Rebuild D at least every this many frames,
+            defaults to 10. None for no limit
+        :type refresh_every: int, optional
+        :param max_displacement: Rebuild D once a node moved this far since
+            the last build, defaults to None (no limit)
+        :type max_displacement: float, optional
+        """
+        if refresh_every is not None and refresh_every < 1:
+            raise ValueError(f"refresh_every must be at least 1, got {refresh_every}")
+        self.refresh_every = refresh_every
+        self.max_displacement = max_displacement
+        self.D = None
+        self.stats = StalenessStats()
+        # positions that D was built from
+        self._reference = None
+
+    def _stale(self, coordinates):
+        # Whether D is out of budget for these positions
+        if self.D is None or self._reference.shape != coordinates.shape:
+            return True
+        if self.refresh_every is not None and self.stats.age >= self.refresh_every:
+            return True
+        if self.max_displacement is not None:
+            self.stats.max_displacement = float(np.sqrt(
+                np.max(np.sum((coordinates - self._reference)**2, axis=1), initial=0)
+            ))
+            return self.stats.max_displacement > self.max_displacement
+        return False
+
+    def step(
+        self,
+        coordinates,
+        dt: float = 1/60,
+        K: int = 10,
+        M = None,
+        rng = None
+    ):
+        """Advance the physical layer by one frame.
+
+        :param coordinates: Array of x, y coordinates, shape (N, 2)
+        :type coordinates: np.ndarray
+        :param dt: Timestep, defaults to 1/60
+        :type dt: float, optional
+        :param K: Number of channels, defaults to 10
+        :type K: int, optional
+        :param M: Message matrix to use instead of sampling one, defaults to None
+        :type M: np.ndarray, optional
+        :param rng: Seed or generator to sample M with, defaults to None (see as_rng)
+        :type rng: int or np.random.Generator, optional
+
+        :returns: Same as example_physical_simulation; A is always None.
+            D is the cached matrix, which later steps may keep using.
+        """
+        coordinates = np.reshape(np.asarray(coordinates, dtype=float), (-1, 2))
+        N = len(coordinates)
+
+        if M is None:
+            M = (as_rng(rng).random((N, K)) < dt).astype(int)
+
+        if self._stale(coordinates):
+            self._reference = coordinates.copy()
+            self.D = inverse_square_distances(coordinates)
+            self.stats.rebuilds += 1
+            self.stats.age = 0
+            self.stats.max_displacement = 0.0
+        self.stats.age += 1
+        self.stats.frames += 1
+
+        Ar = self.D @ M
+        total_messages_sent = np.sum(M)
+        total_message_received = count_receptions(self.D, M, Ar)
+        return total_messages_sent, total_message_received, M, self.D, None, Ar
+
+
+def _normal_cdf(z):
+    # Standard normal CDF, via Abramowitz & Stegun 7.1.26 (error < 1.5e-7)
+    x = np.abs(z) / np.sqrt(2)
+    t = 1 / (1 + 0.3275911*x)
+    poly = t*(0.254829592 + t*(-0.284496736 + t*(1.421413741 + t*(-1.453152027 + t*1.061405429))))
+    erf = 1 - poly*np.exp(-x*x)
+    return 0.5 * (1 + np.sign(z)*erf)
+
+
+def reception_probabilities(D, p: float, exact_terms: int = 6, tail_mass: float = 1e-9):
+    """Probability that i receives a message that j sent, given that j sent one.
+
+    j is received by i on channel k iff D[i,j] > S, where S is the loudness at i
+    of every other transmitter on k, each sending independently with probability p.
+    Any interferer at least as loud as j blocks it on its own, so those must all
+    be silent, with probability (1-p)^(number of them). Of the quieter ones, the
+    exact_terms loudest are summed exactly over their on/off combinations.
+    The n others in the remainder are all silent with probability (1-p)^n,
+    and exactly one sends with probability n*p*(1-p)^(n-1), equally likely any
+    of them; both cases are exact. Only when two or more send is their sum
+    approximated, by a lognormal with the conditional mean and variance,
+    as it is nonnegative and skewed by the few nearby nodes. So small p, where
+    the remainder is mostly silent, is handled well too: at dt=1/60 and N up
+    to 500 the expected receptions are within 2% of Monte Carlo.
+    This is exact whenever N - 2 <= exact_terms.
+
+    :param D: Inverse-square distance matrix, shape (N, N)
+    :type D: np.ndarray
+    :param p: Probability that a node sends on a channel in one frame
+    :type p: float
+    :param exact_terms: Number of quieter interferers summed exactly, defaults to 6
+    :type exact_terms: int, optional
+    :param tail_mass: Skip on/off combinations of those that are together
+        less likely than this, defaults to 1e-9
+    :type tail_mass: float, optional
+    :return: P[i,j], shape (N, N), with a zero diagonal
+    :rtype: np.ndarray
+    """
+    N = len(D)
+    P = np.zeros((N, N))
+    if N < 2:
+        return P
+    n = N - 1
+    m = max(0, min(exact_terms, N - 2))
+
+    # on/off combinations of the m exact interferers, fewest on first,
+    # dropping the least likely ones with up to tail_mass between them
+    on = (np.arange(2**m)[:, None] >> np.arange(m)[None, :]) & 1
+    num_on = on.sum(axis=1)
+    on = on[np.argsort(num_on, kind='stable')]
+    num_on = np.sort(num_on)
+    combination_probability = p**num_on * (1 - p)**(m - num_on)
+    dropped = np.cumsum(combination_probability[::-1])[::-1] <= tail_mass
+    on, combination_probability = on[~dropped], combination_probability[~dropped]
+
+    ranks = np.arange(n)
+    # the m interferers right after j in loudness order, padded past the end
+    after = ranks[:, None] + 1 + np.arange(m)[None, :]
+    rest = np.minimum(ranks + 1 + m, n)
+    rest_count = n - rest
+    silent = (1 - p)**rest_count
+    # exactly one of the remainder sends, or at least two
+    one = rest_count * p * (1 - p)**np.maximum(rest_count - 1, 0)
+    several = np.clip(1 - silent - one, 0, None)
+    louder_silent = (1 - p)**ranks
+
+    for ii in range(N):
+        jj = np.delete(np.arange(N), ii)
+        order = np.argsort(-D[ii, jj], kind='stable')
+        d = D[ii, jj][order]
+        padded = np.append(d, 0)
+        strong = padded[np.minimum(after, n)]
+
+        # sum and sum of squares of the remainder, from suffix sums
+        suffix = np.append(np.cumsum(d[::-1])[::-1], 0)
+        suffix_sq = np.append(np.cumsum((d**2)[::-1])[::-1], 0)
+        rest_sum, rest_sq = suffix[rest], suffix_sq[rest]
+
+        # mean and std of the remainder, given that two or more of it send
+        alone = p * (1 - p)**np.maximum(rest_count - 1, 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = (p*rest_sum - alone*rest_sum) / several
+            second_moment = (p*(1 - p)*rest_sq + (p*rest_sum)**2 - alone*rest_sq) / several
+            std = np.sqrt(np.clip(second_moment - mean**2, 0, None))
+
+        margin = d[:, None] - strong @ on.T
+        # given that exactly one sends, it is equally likely to be any of them,
+        # and the remainder is a suffix of d, so count those quieter than the margin
+        quieter = np.searchsorted(d[::-1], margin, side='left')
+        with np.errstate(divide='ignore', invalid='ignore'):
+            one_below = np.minimum(quieter, rest_count[:, None]) / rest_count[:, None]
+            # lognormal with that mean and std
+            sigma = np.sqrt(np.log1p((std/mean)**2))
+            mu = np.log(mean) - sigma**2/2
+            several_below = np.where(
+                sigma[:, None] > 0,
+                _normal_cdf((np.log(np.clip(margin, 1e-300, None)) - mu[:, None]) / sigma[:, None]),
+                margin > mean[:, None]
+            )
+        quiet_enough = (margin > 0) * (
+            silent[:, None]
+            + np.nan_to_num(one[:, None]*one_below)
+            + np.nan_to_num(several[:, None]*several_below)
+        )
+        P[ii, jj[order]] = louder_silent * (quiet_enough @ combination_probability)
+    return P
+
+
+def expected_physical_simulation(
+    coordinates,
+    dt: float = 1/60,
+    K: int = 10,
+    exact_terms: int = 6,
+    rng = None
+):
+    """Expected messages sent and received per frame, instead of one sample.
+
+    Each node sends on each channel with probability dt, as in
+    example_physical_simulation, and channels are independent. So
+    E[sent] = N*K*dt and E[received] = K*dt * sum_ij P[i,j],
+    with P from reception_probabilities.
+
+    :param coordinates: Array of x, y coordinates, shape (N, 2)
+    :type coordinates: np.ndarray
+    :param dt: Timestep, defaults to 1/60
+    :type dt: float, optional
+    :param K: Number of channels, defaults to 10
+    :type K: int, optional
+    :param exact_terms: Number of quieter interferers summed exactly, defaults to 6
+    :type exact_terms: int, optional
+    :param rng: Unused, as nothing is sampled. Accepted so that this
+        can stand in for the other physical layers, defaults to None
+    :type rng: int or np.random.Generator, optional
+
+    :returns: Expected messages sent, expected messages received,
+        plus D and the reception probabilities P.
+    """
+    coordinates = np.reshape(np.asarray(coordinates, dtype=float), (-1, 2))
+    N = len(coordinates)
+    p = min(max(dt, 0), 1)
+
+    D = inverse_square_distances(coordinates)
+    P = reception_probabilities(D, p, exact_terms)
+    return N*K*p, K*p*P.sum(), D, P
@@ -0,0 +1,543 @@
+"""Headless simulation, without pygame or a display.
+
+Used for batch experiments, where only the network metrics matter.
+"""
+import math
+import os
+from contextlib import nullcontext
+from dataclasses import dataclass
+from functools import partial
+
+import numpy as np
+
+from metrics import MetricsWriter
+from toolkit import Swarm, example_physical_simulation, batched_physical_simulation, polar_step, default_drdt, broadcast_throughput, DtypePolicy, FLOAT32, FLOAT64
+
+
+def _normal_quantile(q: float):
+    # Inverse standard normal CDF, for 0 < q < 1: Acklam's rational
+    # approximation (error < 1.2e-9), then one Halley step on math.erfc
+    a = (-3.969683028665376e+01, 2.209460984245205e+02, -2.759285104469687e+02,
+         1.383577518672690e+02, -3.066479806614716e+01, 2.506628277459239e+00)
+    b = (-5.447609879822406e+01, 1.615858368580409e+02, -1.556989798598866e+02,
+         6.680131188771972e+01, -1.328068155288572e+01)
+    c = (-7.784894002430293e-03, -3.223964580411365e-01, -2.400758277161838e+00,
+         -2.549732539343734e+00, 4.374664141464968e+00, 2.938163982698783e+00)
+    d = (7.784695709041462e-03, 3.224671290700398e-01, 2.445134137142996e+00,
+         3.754408661907416e+00)
+    tail = min(q, 1 - q)
+    if tail < 0.02425:
+        t = math.sqrt(-2 * math.log(tail))
+        z = (((((c[0]*t + c[1])*t + c[2])*t + c[3])*t + c[4])*t + c[5]) / \
+            ((((d[0]*t + d[1])*t + d[2])*t + d[3])*t + 1)
+        z = z if q < 0.5 else -z
+    else:
+        t = (q - 0.5)**2
+        z = (((((a[0]*t + a[1])*t + a[2])*t + a[3])*t + a[4])*t + a[5])*(q - 0.5) / \
+            (((((b[0]*t + b[1])*t + b[2])*t + b[3])*t + b[4])*t + 1)
+    error = 0.5 * math.erfc(-z / math.sqrt(2)) - q
+    step = error * math.sqrt(2*math.pi) * math.exp(z*z / 2)
+    return z - step / (1 + z*step/2)
+
+
+@dataclass
+class SimulationResult:
+    '''
+    Outcome of a headless run.
+
+    sent and received hold the per-frame message counts.
+    '''
+    N: int
+    K: int
+    dt: float
+    throughput: float
+    sent: np.ndarray
+    received: np.ndarray
+
+    @property
+    def frames(self):
+        return len(self.sent)
+
+
+class ThroughputAggregator:
+    def __init__(self, N: int, batch: int = 1, confidence: float = 0.95, min_batches: int = 10):
+        """Running broadcast throughput, with a confidence interval.
+
+        Keeps running totals, plus Welford estimates of the variance and
+        covariance of the messages received, and sent*(N-1), per batch of
+        frames. Throughput is a ratio of the two, so its standard error comes
+        from the delta method. Consecutive frames are correlated through
+        the positions, so batches of about a second (batch=fps) make the
+        interval more honest than batch=1.
+
+        :param N: Number of nodes
+        :type N: int
+        :param batch: Frames per batch, defaults to 1
+        :type batch: int, optional
+        :param confidence: Confidence level of the interval, defaults to 0.95
+        :type confidence: float, optional
+        :param min_batches: Batches needed before converged() can be True, defaults to 10
+        :type min_batches: int, optional
+        """
+        if batch < 1:
+            raise ValueError(f"batch must be at least 1, got {batch}")
+        self.N = N
+        self.batch = batch
+        self.min_batches = max(2, min_batches)
+        self._z = _normal_quantile((1 + confidence) / 2)
+
+        self.frames = 0
+        self.total_sent = 0
+        self.total_received = 0
+        self._batch_sent = 0
+        self._batch_received = 0
+
+        # Welford state over completed batches: x = sent*(N-1), y = received
+        self.batches = 0
+        self._mean_x = 0.0
+        self._mean_y = 0.0
+        self._Sxx = 0.0
+        self._Syy = 0.0
+        self._Sxy = 0.0
+
+    def add(self, sent, received):
+        """Add one frame's messages sent and received."""
+        self.frames += 1
+        self.total_sent += sent
+        self.total_received += received
+        self._batch_sent += sent
+        self._batch_received += received
+        if self.frames % self.batch == 0:
+            self._push(self._batch_sent * (self.N - 1), self._batch_received)
+            self._batch_sent = 0
+            self._batch_received = 0
+
+    def _push(self, x, y):
+        self.batches += 1
+        dx = x - self._mean_x
+        dy = y - self._mean_y
+        self._mean_x += dx / self.batches
+        self._mean_y += dy / self.batches
+        self._Sxx += dx * (x - self._mean_x)
+        self._Syy += dy * (y - self._mean_y)
+        self._Sxy += dx * (y - self._mean_y)
+
+    @property
+    def throughput(self):
+        """Throughput over all frames so far."""
+        return broadcast_throughput(self.total_received, self.total_sent, self.N)
+
+    @property
+    def half_width(self):
+        """Half-width of the confidence interval, or inf with fewer than two batches."""
+        if self.batches < 2 or self._mean_x == 0:
+            return np.inf
+        ratio = self._mean_y / self._mean_x
+        variance = (self._Syy - 2*ratio*self._Sxy + ratio**2 * self._Sxx) / (self.batches - 1)
+        return self._z * np.sqrt(max(variance, 0) / self.batches) / self._mean_x
+
+    def interval(self):
+        """Confidence interval of the throughput, as (low, high)."""
+        throughput, half_width = self.throughput, self.half_width
+        return throughput - half_width, throughput + half_width
+
+    def converged(self, target_width: float):
+        """Whether the confidence interval is narrower than target_width."""
+        return self.batches >= self.min_batches and 2*self.half_width < target_width
+
+
+def simulate(
+    N: int = 40,
+    K: int = 10,
+    fps: int = 60,
+    total_time: float = 120,
+    seed = None,
+    physical_layer = example_physical_simulation,
+    metrics = None,
+    metrics_per_node: bool = False,
+    dtypes: DtypePolicy = FLOAT64,
+    target_width: float = None,
+    tolerance: float = None,
+):
+    """Run the network experiment on the particle swarm, headless.
+
+    Same simulation as main.main, but without rendering,
+    so pygame is never imported and no display is needed.
+
+    :param N: Number of nodes, defaults to 40
+    :type N: int, optional
+    :param K: Number of channels, defaults to 10
+    :type K: int, optional
+    :param fps: Frames per second, controls dt timestep, defaults to 60
+    :type fps: int, optional
+    :param total_time: Total time (in seconds) to simulate, defaults to 120
+    :type total_time: float, optional
+    :param seed: Seed or generator for every random draw of the run,
+        defaults to None (fresh entropy)
+    :type seed: int, np.random.SeedSequence or np.random.Generator, optional
+    :param physical_layer: Function called as physical_layer(coordinates, dt, K, rng=rng)
+        every frame, returning messages sent and received first. E.g.
+        functools.partial(physical.sparse_physical_simulation, cutoff=20) or
+        physical.IncrementalPhysicalLayer(tolerance=1).step. With
+        physical.expected_physical_simulation the counters are expected values.
+        Defaults to example_physical_simulation
+    :type physical_layer: Function, optional
+    :param metrics: File to stream per-frame metrics to (see metrics.MetricsWriter).
+        Per-channel and per-node counts need a physical layer returning
+        (sent, received, M, D, ..., Ar) with a dense D, like example_physical_simulation.
+        Defaults to None (not recorded)
+    :type metrics: str, optional
+    :param metrics_per_node: Also record per-node counts, defaults to False
+    :type metrics_per_node: bool, optional
+    :param dtypes: Dtypes of the swarm positions, and of the physical layer
+        if it is example_physical_simulation. E.g. toolkit.FLOAT32, see
+        compare_precision. Defaults to FLOAT64
+    :type dtypes: DtypePolicy, optional
+    :param target_width: Stop early, once the 95% confidence interval of the
+        throughput is narrower than this (see ThroughputAggregator, with
+        one-second batches). total_time is then the longest a run may take.
+        Defaults to None (always run for total_time)
+    :type target_width: float, optional
+    :param tolerance: Integrate the swarm's motion adaptively to this position
+        error per frame (see toolkit.adaptive_polar_step), so a large dt
+        doesn't degrade the motion. Defaults to None (one Euler step per frame)
+    :type tolerance: float, optional
+    :return: Throughput and per-frame counters
+    :rtype: SimulationResult
+    """
+    rng = np.random.default_rng(seed)
+    if physical_layer is example_physical_simulation:
+        physical_layer = partial(example_physical_simulation, dtypes=dtypes)
+
+    dt = 1/fps
+    # No tails are drawn, so only the current position is kept
+    swarm = Swarm(N=N, hist_length=1, rng=rng, dtype=dtypes.position, tolerance=tolerance)
+    return _run_network(
+        _swarm_frames(swarm, dt, total_time), N, K, dt, rng,
+        physical_layer, metrics, metrics_per_node, target_width
+    )
+
+
+@dataclass
+class FidelityComparison:
+    '''
+    The same run (same seed) at a reference and a reduced fidelity,
+    e.g. float32 instead of float64, or a stale D.
+    '''
+    reference: SimulationResult
+    reduced: SimulationResult
+
+    @property
+    def error(self):
+        """Throughput at reduced fidelity minus throughput at the reference."""
+        return self.reduced.throughput - self.reference.throughput
+
+    @property
+    def frames_differing(self):
+        """Number of frames where the messages received differ."""
+        return int(np.count_nonzero(self.reduced.received != self.reference.received))
+
+
+def compare_precision(
+    N: int = 40,
+    K: int = 10,
+    fps: int = 60,
+    total_time: float = 20,
+    seed = 0,
+    dtypes: DtypePolicy = FLOAT32,
+    reference: DtypePolicy = FLOAT64,
+):
+    """Measure how much a dtype policy changes the results.
+
+    Runs simulate twice with the same seed. The swarm's motion and the
+    messages are drawn identically, so only rounding differs.
+
+    :param N: Number of nodes, defaults to 40
+    :type N: int, optional
+    :param K: Number of channels, defaults to 10
+    :type K: int, optional
+    :param fps: Frames per second, controls dt timestep, defaults to 60
+    :type fps: int, optional
+    :param total_time: Total time (in seconds) to simulate, defaults to 20
+    :type total_time: float, optional
+    :param seed: Seed of both runs, defaults to 0
+    :type seed: int, optional
+    :param dtypes: Reduced precision policy, defaults to FLOAT32
+    :type dtypes: DtypePolicy, optional
+    :param reference: Policy to compare against, defaults to FLOAT64
+    :type reference: DtypePolicy, optional
+    :return: Both results
+    :rtype: FidelityComparison
+    """
+    kwargs = dict(N=N, K=K, fps=fps, total_time=total_time, seed=seed)
+    return FidelityComparison(
+        reference = simulate(dtypes=reference, **kwargs),
+        reduced = simulate(dtypes=dtypes, **kwargs),
+    )
+
+
+def compare_physical_layers(
+    physical_layer,
+    reference = example_physical_simulation,
+    N: int = 40,
+    K: int = 10,
+    fps: int = 60,
+    total_time: float = 20,
+    seed = 0,
+):
+    """Measure how much an approximate physical layer changes the results.
+
+    Runs simulate with both layers and the same seed. E.g. for the
+    throughput error of a staleness budget on D,
+    compare_physical_layers(physical.CachedPhysicalLayer(refresh_every=30).step).error
+    Layers that sample M like example_physical_simulation see the same
+    motion and messages, so only the approximation differs.
+
+    :param physical_layer: Approximate physical layer, as for simulate
+    :type physical_layer: Function
+    :param reference: Physical layer to compare against, defaults to example_physical_simulation
+    :type reference: Function, optional
+    :param N: Number of nodes, defaults to 40
+    :type N: int, optional
+    :param K: Number of channels, defaults to 10
+    :type K: int, optional
+    :param fps: Frames per second, controls dt timestep, defaults to 60
+    :type fps: int, optional
+    :param total_time: Total time (in seconds) to simulate, defaults to 20
+    :type total_time: float, optional
+    :param seed: Seed of both runs, defaults to 0
+    :type seed: int, optional
+    :return: Both results
+    :rtype: FidelityComparison
+    """
+    kwargs = dict(N=N, K=K, fps=fps, total_time=total_time, seed=seed)
+    return FidelityComparison(
+        reference = simulate(physical_layer=reference, **kwargs),
+        reduced = simulate(physical_layer=physical_layer, **kwargs),
+    )
+
+
+def _frames(dt, total_time):
+    # Number of frames in `while tt < total_time: tt += dt`, float error included
+    frames = 0
+    tt = 0 # timestep
+    while tt < total_time:
+        frames += 1
+        tt += dt
+    return frames
+
+
+def _swarm_frames(swarm, dt, total_time):
+    # Advance the swarm one frame at a time, lazily, so its random draws
+    # stay interleaved with the physical layer's
+    for _ in range(_frames(dt, total_time)):
+        swarm.update(dt=dt)
+        yield swarm.coordinates
+
+
+def _run_network(frames, N, K, dt, rng, physical_layer, metrics=None, metrics_per_node=False, target_width=None):
+    # Simulate the network over an iterable of (N, 2) coordinates, one per frame
+    aggregator = None
+    if target_width is not None:
+        aggregator = ThroughputAggregator(N, batch=max(1, round(1/dt)))
+
+    writer = None
+    if metrics is not None:
+        writer = MetricsWriter(metrics, K=K, N=N if metrics_per_node else 0)
+
+    sent = []
+    received = []
+
+    with writer or nullcontext():
+        for ti, coordinates in enumerate(frames):
+            out = physical_layer(coordinates, dt, K, rng=rng)
+            tot_sent, tot_recv = out[:2]
+            sent.append(tot_sent)
+            received.append(tot_recv)
+            if writer is not None:
+                writer.record((ti + 1)*dt, tot_sent, tot_recv, *_dense_matrices(out, N, K))
+            if aggregator is not None:
+                aggregator.add(tot_sent, tot_recv)
+                if aggregator.converged(target_width):
+                    break
+
+    # floats if the physical layer returns expected counts
+    sent = np.array(sent)
+    received = np.array(received)
+    return SimulationResult(
+        N = N,
+        K = K,
+        dt = dt,
+        throughput = broadcast_throughput(received.sum(), sent.sum(), N),
+        sent = sent,
+        received = received,
+    )
+
+
+def record_trajectory(
+    path,
+    N: int = 40,
+    fps: int = 60,
+    total_time: float = 120,
+    seed = None,
+):
+    """Record the swarm's positions to a memory-mapped .npy file.
+
+    The file holds one frame per timestep, shape (frames, N, 2), as float32.
+    It is written frame by frame, so the trajectory never has to fit in memory.
+    Replay it with replay_trajectory, e.g. once per K.
+
+    :param path: File to write, conventionally ending in .npy
+    :type path: str
+    :param N: Number of nodes, defaults to 40
+    :type N: int, optional
+    :param fps: Frames per second, controls dt timestep, defaults to 60
+    :type fps: int, optional
+    :param total_time: Total time (in seconds) to simulate, defaults to 120
+    :type total_time: float, optional
+    :param seed: Seed or generator for the swarm, defaults to None (fresh entropy)
+    :type seed: int, np.random.SeedSequence or np.random.Generator, optional
+    :return: The recorded trajectory, memory-mapped read-only
+    :rtype: np.memmap
+    """
+    rng = np.random.default_rng(seed)
+    dt = 1/fps
+    swarm = Swarm(N=N, hist_length=1, rng=rng)
+
+    frames = _frames(dt, total_time)
+    trajectory = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=(frames, N, 2))
+    for ti, coordinates in enumerate(_swarm_frames(swarm, dt, total_time)):
+        trajectory[ti] = coordinates
+    trajectory.flush()
+    del trajectory
+    return load_trajectory(path)
+
+
+def load_trajectory(path):
+    """Open a trajectory written by record_trajectory, memory-mapped read-only.
+
+    :param path: File written by record_trajectory
+    :type path: str
+    :return: Positions, shape (frames, N, 2)
+    :rtype: np.memmap
+    """
+    return np.load(path, mmap_mode='r')
+
+
+def replay_trajectory(
+    trajectory,
+    K: int = 10,
+    fps: int = 60,
+    seed = None,
+    physical_layer = example_physical_simulation,
+    metrics = None,
+    metrics_per_node: bool = False,
+):
+    """Run the network over a recorded trajectory, instead of a live swarm.
+
+    Only the physical layer is simulated, so sweeping e.g. K over one
+    mobility trace costs the network layer alone. Frames are read from
+    the memory map one at a time, without copying the trajectory.
+
+    :param trajectory: Path of a recorded trajectory, or an array of shape (frames, N, 2)
+    :type trajectory: str or np.ndarray
+    :param K: Number of channels, defaults to 10
+    :type K: int, optional
+    :param fps: Frames per second it was recorded at, defaults to 60
+    :type fps: int, optional
+    :param seed: Seed or generator for the messages, defaults to None (fresh entropy)
+    :type seed: int, np.random.SeedSequence or np.random.Generator, optional
+    :param physical_layer: As for simulate, defaults to example_physical_simulation
+    :type physical_layer: Function, optional
+    :param metrics: As for simulate, defaults to None (not recorded)
+    :type metrics: str, optional
+    :param metrics_per_node: As for simulate, defaults to False
+    :type metrics_per_node: bool, optional
+    :return: Throughput and per-frame counters
+    :rtype: SimulationResult
+    """
+    if isinstance(trajectory, (str, os.PathLike)):
+        trajectory = load_trajectory(trajectory)
+    N = trajectory.shape[1]
+    return _run_network(
+        iter(trajectory), N, K, 1/fps, np.random.default_rng(seed),
+        physical_layer, metrics, metrics_per_node
+    )
+
+
+def _dense_matrices(out, N, K):
+    # M, D and Ar from the physical layer's output, or None where it doesn't have them
+    if len(out) < 5:
+        return None, None, None
+    M, D, Ar = out[2], out[3], out[-1]
+    if np.shape(M) != (N, K) or np.shape(Ar) != (N, K):
+        return None, None, None
+    if not isinstance(D, np.ndarray) or D.shape != (N, N):
+        return M, None, None
+    return M, D, Ar
+
+
+def simulate_replicas(
+    R: int = 8,
+    N: int = 40,
+    K: int = 10,
+    fps: int = 60,
+    total_time: float = 120,
+    seed = None,
+):
+    """Run R independent headless simulations as one array program.
+
+    The R swarms are advanced together as (R, N) arrays, and the
+    R physical layers are simulated with batched_physical_simulation.
+
+    :param R: Number of replicas, defaults to 8
+    :type R: int, optional
+    :param N: Number of nodes, defaults to 40
+    :type N: int, optional
+    :param K: Number of channels, defaults to 10
+    :type K: int, optional
+    :param fps: Frames per second, controls dt timestep, defaults to 60
+    :type fps: int, optional
+    :param total_time: Total time (in seconds) to simulate, defaults to 120
+    :type total_time: float, optional
+    :param seed: Seed or generator for every random draw of the run,
+        defaults to None (fresh entropy)
+    :type seed: int, np.random.SeedSequence or np.random.Generator, optional
+    :return: One result per replica
+    :rtype: List[SimulationResult]
+    """
+    rng = np.random.default_rng(seed)
+    drdt = lambda r: default_drdt(r, rng)
+
+    dt = 1/fps
+    # Initialize each replica like a Swarm would, then stack them
+    coordinates = np.stack([Swarm(N=N, hist_length=1, rng=rng).coordinates for _ in range(R)])
+    x, y = coordinates[..., 0], coordinates[..., 1]
+
+    sent = []
+    received = []
+
+    tt = 0 # timestep
+    while tt < total_time:
+        _, _, x, y = polar_step(x, y, dt, drdt)
+        tot_sent, tot_recv, _, _, _ = batched_physical_simulation(
+            np.stack([x, y], axis=-1), dt, K, rng=rng
+        )
+        sent.append(tot_sent)
+        received.append(tot_recv)
+        tt += dt
+
+    # (frames, R) -> one row per replica
+    sent = np.array(sent, dtype=int).reshape(-1, R).T
+    received = np.array(received, dtype=int).reshape(-1, R).T
+    return [
+        SimulationResult(
+            N = N,
+            K = K,
+            dt = dt,
+            throughput = broadcast_throughput(received[rr].sum(), sent[rr].sum(), N),
+            sent = sent[rr],
+            received = received[rr],
+        )
+        for rr in range(R)
+    ]
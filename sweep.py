@@ -0,0 +1,143 @@
+"""Parallel parameter sweeps over headless simulations.
+
+Each (N, K, fps, T) configuration is run once per seed on a process pool,
+then the throughputs are aggregated into markdown tables.
+"""
+import itertools
+import os
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import List, Sequence, Tuple
+
+import numpy as np
+
+from simulation import simulate
+
+
+@dataclass
+class SweepResult:
+    '''
+    Aggregated throughput of one configuration over all seeds.
+    '''
+    N: int
+    K: int
+    fps: int
+    total_time: float
+    throughputs: np.ndarray
+    # simulated seconds per seed, below total_time if stopped early
+    simulated_times: np.ndarray = None
+
+    @property
+    def dt(self):
+        return 1/self.fps
+
+    @property
+    def mean(self):
+        return float(np.mean(self.throughputs))
+
+    @property
+    def std(self):
+        if len(self.throughputs) < 2:
+            return 0.0
+        return float(np.std(self.throughputs, ddof=1))
+
+
+def _run_task(task):
+    # Top-level so it can be pickled for the process pool
+    (N, K, fps, total_time), seed_sequence, target_width = task
+    # One independent stream per task, from its own SeedSequence
+    result = simulate(N=N, K=K, fps=fps, total_time=total_time, seed=seed_sequence, target_width=target_width)
+    return result.throughput, result.frames * result.dt
+
+
+def run_sweep(
+    Ns: Sequence[int] = (40,),
+    Ks: Sequence[int] = (10,),
+    fpses: Sequence[int] = (60,),
+    Ts: Sequence[float] = (20,),
+    seeds: Sequence[int] = (0,),
+    workers: int = None,
+    target_width: float = None,
+) -> List[SweepResult]:
+    """Run every combination of N, K, fps and T once per seed.
+
+    Each seed is expanded with numpy's SeedSequence into one child stream
+    per configuration, so no two runs share random numbers.
+
+    :param Ns: Numbers of nodes, defaults to (40,)
+    :type Ns: Sequence[int], optional
+    :param Ks: Numbers of channels, defaults to (10,)
+    :type Ks: Sequence[int], optional
+    :param fpses: Frames per second, defaults to (60,)
+    :type fpses: Sequence[int], optional
+    :param Ts: Total simulated times in seconds, defaults to (20,)
+    :type Ts: Sequence[float], optional
+    :param seeds: Seeds, one replicate each, defaults to (0,)
+    :type seeds: Sequence[int], optional
+    :param workers: Number of worker processes, defaults to None (one per CPU).
+        With 1, runs serially in this process.
+    :type workers: int, optional
+    :param target_width: Stop each run once its throughput confidence interval
+        is narrower than this, with T as the limit (see simulation.simulate).
+        Defaults to None (every run takes T)
+    :type target_width: float, optional
+    :return: One result per configuration, in grid order
+    :rtype: List[SweepResult]
+    """
+    configs = list(itertools.product(Ns, Ks, fpses, Ts))
+    streams = [np.random.SeedSequence(seed).spawn(len(configs)) for seed in seeds]
+    tasks = [
+        (config, streams[ss][cc], target_width)
+        for cc, config in enumerate(configs)
+        for ss in range(len(seeds))
+    ]
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    if workers == 1:
+        outcomes = list(map(_run_task, tasks))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            outcomes = list(pool.map(_run_task, tasks))
+
+    throughputs, simulated = np.reshape(outcomes, (len(configs), len(seeds), 2)).transpose(2, 0, 1)
+    return [
+        SweepResult(N, K, fps, total_time, throughputs[cc], simulated[cc])
+        for cc, (N, K, fps, total_time) in enumerate(configs)
+    ]
+
+
+# Table columns: header and how to format each result
+_COLUMNS = {
+    'N':   ('N',   lambda res: f"{res.N}"),
+    'K':   ('K',   lambda res: f"{res.K}"),
+    'fps': ('FPS', lambda res: f"{res.fps}"),
+    'dt':  ('dt',  lambda res: f"{res.dt:.3f}"),
+    'T':   ('T',   lambda res: f"{res.total_time}"),
+    'simulated': ('simulated T', lambda res: f"{np.mean(res.simulated_times):.1f}"),
+}
+
+
+def markdown_table(results: List[SweepResult], columns: Tuple[str, ...] = ('N',)):
+    """Format sweep results as a markdown table, with a throughput column.
+
+    E.g. columns=('fps', 'dt') gives `| FPS | dt | throughput |`.
+
+    :param results: Output of run_sweep
+    :type results: List[SweepResult]
+    :param columns: Which of 'N', 'K', 'fps', 'dt', 'T', 'simulated' to show, defaults to ('N',)
+    :type columns: Tuple[str, ...], optional
+    :return: The table, one row per line
+    :rtype: str
+    """
+    headers = [_COLUMNS[col][0] for col in columns] + ["throughput"]
+    lines = [
+        "| " + " | ".join(headers) + " |",
+        "| " + " | ".join("-" * len(header) for header in headers) + " |",
+    ]
+    for res in results:
+        cells = [_COLUMNS[col][1](res) for col in columns]
+        cells.append(f"{res.mean*100:.1f}% ± {res.std*100:.1f}%")
+        lines.append("| " + " | ".join(cells) + " |")
+    return "\n".join(lines)
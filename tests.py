@@ -1,11 +1,46 @@
+import os
+import subprocess
+import tempfile
+from dataclasses import replace
+from functools import partial
+import sys
 import unittest as ut
+import unittest.mock
 import numpy as np
 
-from toolkit import Node, Swarm, example_physical_simulation, polar_to_xy, center_origin
+from toolkit import Node, Swarm, default_drift, example_physical_simulation, batched_physical_simulation, polar_to_xy, center_origin, draw_M, PhaseTimer, FLOAT32
 
 from palette import S16, s16_raw, interpolate_color
 
 from main import main
+from simulation import simulate, simulate_replicas, broadcast_throughput, record_trajectory, replay_trajectory, compare_precision, compare_physical_layers, ThroughputAggregator
+from sweep import run_sweep, markdown_table
+from benchmark import run_benchmarks, save_results, load_results, compare
+import kernels
+from metrics import MetricsWriter, read_metrics, reception_counts
+from physical import CachedPhysicalLayer, grid_neighbor_pairs, sparse_physical_simulation, parallel_physical_simulation, chunked_physical_simulation, event_physical_simulation, cutoff_throughput_error, IncrementalPhysicalLayer, expected_physical_simulation
+
+
+def _reference_physical_simulation(coordinates, dt, K):
+    # The original loop-based physical layer, kept to check the vectorized one
+    N = len(coordinates)
+    D = np.zeros((N, N))
+    for ii in range(N):
+        xi, yi = coordinates[ii]
+        for jj in range(N):
+            xj, yj = coordinates[jj]
+            if ii != jj:
+                D[ii,jj] = ((xi - xj)**2 + (yi - yj)**2)**-1
+    M = (np.random.random((N, K)) < dt).astype(int)
+    Ar = D @ M
+    A = np.einsum('ij,jk->ijk',D,M)
+    total_message_received = 0
+    for ii in range(N):
+        for jj in range(N):
+            for kk in range(K):
+                if Ar[ii, kk] != 0 and A[ii,jj,kk] / Ar[ii, kk] > 1/2:
+                    total_message_received += 1
+    return np.sum(M), total_message_received, M, D, A, Ar
 
 class NodeTests(ut.TestCase):
     def test_updated_hist(self):
@@ -74,6 +109,130 @@ class SwarmTests(ut.TestCase):
                     dt = np.random.random()
                 )
 
+    def test_swarm_history_ring_buffer(self):
+        # The views should behave like the old list-based Node histories
+        hist_length = 7
+        swarm = Swarm(N=5, hist_length=hist_length)
+        nodes = [Node(x=n.X[0], y=n.Y[0], hist_length=hist_length) for n in swarm.nodes]
+        for _ in range(20):
+            swarm.update(dt=1/30)
+            for node, ref in zip(swarm.nodes, nodes):
+                ref.update(node.X[0], node.Y[0])
+
+        for node, ref in zip(swarm.nodes, nodes):
+            self.assertEqual(node.X[:], ref.X)
+            self.assertEqual(node.Y[:], ref.Y)
+            self.assertEqual(node.X[-1], ref.X[-1])
+
+        history = swarm.history()
+        self.assertEqual(history.shape, (hist_length, 5, 2))
+        np.testing.assert_equal(history[0], swarm.coordinates)
+        np.testing.assert_equal(history[3, 2], (swarm.nodes[2].X[3], swarm.nodes[2].Y[3]))
+
+        # nodes are moved by the swarm, not one at a time
+        with self.assertRaises(TypeError):
+            swarm.nodes[0].update(1, 2)
+
+    def test_swarm_polar_state(self):
+        swarm = Swarm(N=30)
+        swarm.update(dt=1/60)
+        x, y = polar_to_xy(swarm.r, swarm.theta)
+        np.testing.assert_allclose(swarm.coordinates, np.stack([x, y], axis=1))
+
+    def test_swarm_seeded(self):
+        # Same seed, same trajectory; and the global random state is untouched
+        state = np.random.get_state()
+        swarms = [Swarm(N=20, hist_length=3, rng=np.random.default_rng(7)) for _ in range(2)]
+        for _ in range(10):
+            for swarm in swarms:
+                swarm.update(dt=1/30)
+        np.testing.assert_equal(swarms[0].history(), swarms[1].history())
+        np.testing.assert_equal(np.random.get_state()[1], state[1])
+
+    def test_swarm_custom_init(self):
+        swarm = Swarm(N=6, get_radius=lambda: 10.0, get_theta=lambda: 0.0)
+        np.testing.assert_allclose(swarm.coordinates, [(10.0, 0.0)] * 6)
+
+    def test_swarm_adaptive(self):
+        # Noise-free motion over 1 s: a few large adaptive steps track many small ones
+        def run(dt, tolerance):
+            swarm = Swarm(N=20, hist_length=1, rng=3, tolerance=tolerance)
+            substeps = []
+            for _ in range(round(1/dt)):
+                swarm.update(dt=dt, drdt=default_drift)
+                substeps.append(swarm.substeps)
+            return swarm.coordinates, substeps
+
+        reference, _ = run(1/1000, 1e-6)
+        coarse, substeps = run(1/2, 1e-3)
+        euler, euler_substeps = run(1/2, None)
+        self.assertEqual(euler_substeps, [1, 1])
+        self.assertTrue(all(1 < n <= 256 for n in substeps))
+        np.testing.assert_allclose(coarse, reference, atol=1e-2)
+        self.assertGreater(np.abs(euler - reference).max(), 10*np.abs(coarse - reference).max())
+
+        # a looser tolerance takes fewer substeps
+        _, loose = run(1/2, 1)
+        self.assertLessEqual(sum(loose), sum(substeps))
+
+    def test_swarm_adaptive_max_substeps(self):
+        # An unreachable tolerance takes exactly max_substeps, powers of two or not
+        for max_substeps in (1, 3, 100):
+            swarm = Swarm(N=20, hist_length=1, rng=0, tolerance=0, max_substeps=max_substeps)
+            swarm.update(dt=1/2)
+            self.assertEqual(swarm.substeps, max_substeps)
+        with self.assertRaises(ValueError):
+            Swarm(N=2, tolerance=1e-2, max_substeps=0).update()
+
+    def test_swarm_adaptive_noise(self):
+        # At dt = noise_dt, the noise is the same draws as the Euler step's
+        adaptive = Swarm(N=10, hist_length=1, rng=5, tolerance=1e-2)
+        euler = Swarm(N=10, hist_length=1, rng=5)
+        for _ in range(5):
+            adaptive.update(dt=1/60)
+            euler.update(dt=1/60)
+        self.assertEqual(adaptive.rng.random(), euler.rng.random())
+        np.testing.assert_allclose(adaptive.r, euler.r, atol=.1)
+
+        # and the spread of the motion doesn't depend on dt, unlike with Euler steps
+        def spread(fps, tolerance):
+            swarm = Swarm(N=2000, hist_length=1, rng=1, tolerance=tolerance)
+            for _ in range(10*fps):
+                swarm.update(dt=1/fps)
+            return swarm.r.std()
+        reference = spread(60, None)
+        self.assertAlmostEqual(spread(2, 1e-2), reference, delta=.05*reference)
+        self.assertGreater(spread(2, None), 2*reference)
+
+
+    def test_swarm_draw(self):
+        # Draws to an off-screen surface; no display is needed
+        import pygame
+        screen = pygame.Surface((600, 600))
+        transform = lambda coord: center_origin(coord, 600, 600)
+        for num_nodes in (0, 1, 30):
+            swarm = Swarm(N=num_nodes, hist_length=12)
+            for _ in range(12):
+                swarm.update(dt=1/30)
+            screen.fill(S16.black)
+            swarm.draw(screen, transform=transform)
+            for x, y in swarm.coordinates:
+                x, y = transform((x, y))
+                self.assertEqual(tuple(screen.get_at((int(x), int(y))))[:3], tuple(S16.white[:3]))
+
+    def test_node_draw_tail(self):
+        import pygame
+        screen = pygame.Surface((100, 100))
+        screen.fill(S16.black)
+        node = Node(x=50, y=50, hist_length=8)
+        for ii in range(8):
+            node.update(x=10 + 5*ii, y=50)
+        node.draw_tail(screen)
+        node.draw(screen)
+        self.assertEqual(tuple(screen.get_at((45, 50)))[:3], tuple(S16.white[:3]))
+        self.assertNotEqual(tuple(screen.get_at((15, 50)))[:3], tuple(S16.black[:3]))
+
+
 class UtilTests(ut.TestCase):
     def test_polar_to_xy(self):
         for _ in range(100):
@@ -116,6 +275,501 @@ class UtilTests(ut.TestCase):
             )
 
 
+    def test_physical_matches_reference(self):
+        # Vectorized engine should give the same totals as the original loops
+        for _ in range(6):
+            N = np.random.randint(2, 40)
+            K = np.random.randint(1, 20)
+            dt = np.random.random()
+            coordinates = np.random.uniform(-200, 200, size=(N, 2))
+
+            state = np.random.get_state()
+            expected = _reference_physical_simulation(coordinates, dt, K)
+            np.random.set_state(state)
+            tot_sent, tot_rec, M, D, A, Ar = example_physical_simulation(
+                coordinates, dt, K
+            )
+
+            self.assertEqual(tot_sent, expected[0])
+            self.assertEqual(tot_rec, expected[1])
+            np.testing.assert_equal(M, expected[2])
+            # D may differ from the scalar **-1 in the last ulp
+            np.testing.assert_allclose(D, expected[3], rtol=1e-12)
+            np.testing.assert_allclose(Ar, expected[5], rtol=1e-12)
+            self.assertIsNone(A)
+
+    def test_physical_return_A(self):
+        coordinates = np.random.uniform(-200, 200, size=(10, 2))
+        _, _, M, D, A, Ar = example_physical_simulation(
+            coordinates, dt=.5, K=4, return_A=True
+        )
+        self.assertEqual(A.shape, (10, 10, 4))
+        np.testing.assert_allclose(A.sum(axis=1), Ar)
+
+
+    def test_batched_physical_matches_single(self):
+        R, N, K, dt = 5, 17, 6, .3
+        coordinates = np.random.uniform(-200, 200, size=(R, N, 2))
+
+        # One (R, N, K) draw consumes the same numbers as R (N, K) draws
+        state = np.random.get_state()
+        sent, recv, M, D, Ar = batched_physical_simulation(coordinates, dt, K)
+        np.random.set_state(state)
+        for rr in range(R):
+            tot_sent, tot_rec, M_r, _, _, _ = example_physical_simulation(coordinates[rr], dt, K)
+            self.assertEqual(sent[rr], tot_sent)
+            self.assertEqual(recv[rr], tot_rec)
+            np.testing.assert_equal(M[rr], M_r)
+
+
+    def test_physical_seeded(self):
+        coordinates = np.random.uniform(-200, 200, size=(20, 2))
+        first = example_physical_simulation(coordinates, .3, 5, rng=np.random.default_rng(1))
+        second = example_physical_simulation(coordinates, .3, 5, rng=np.random.default_rng(1))
+        np.testing.assert_equal(first[2], second[2])
+        self.assertEqual(first[1], second[1])
+
+
+class PhysicalTests(ut.TestCase):
+    def test_grid_neighbor_pairs_cover_cutoff(self):
+        coordinates = np.random.uniform(-100, 100, size=(200, 2))
+        cutoff = 15
+        rows, cols = grid_neighbor_pairs(coordinates, cutoff)
+        found = set(zip(rows.tolist(), cols.tolist()))
+
+        distance = np.linalg.norm(coordinates[:, None] - coordinates[None], axis=-1)
+        expected = np.argwhere((distance < cutoff) & ~np.eye(200, dtype=bool))
+        self.assertTrue(set(map(tuple, expected.tolist())) <= found)
+        self.assertTrue(all(ii != jj for ii, jj in found))
+
+    def test_sparse_physical_large_cutoff_is_exact(self):
+        coordinates = np.random.uniform(-200, 200, size=(50, 2))
+        for _ in range(5):
+            tot_sent, tot_rec, M, D, _, Ar = example_physical_simulation(coordinates, .3, 6)
+            sent, received, _, D_sparse, A, Ar_sparse = sparse_physical_simulation(
+                coordinates, .3, 6, cutoff=1000, M=M
+            )
+            self.assertEqual(sent, tot_sent)
+            self.assertEqual(received, tot_rec)
+            self.assertIsNone(A)
+            np.testing.assert_allclose(D_sparse.toarray(), D)
+            np.testing.assert_allclose(Ar_sparse, Ar)
+
+        self.assertEqual(cutoff_throughput_error(coordinates, .3, 6, cutoff=1000), 0)
+
+    def test_sparse_physical_small_cutoff(self):
+        coordinates = np.random.uniform(-200, 200, size=(300, 2))
+        _, _, M, D, _, _ = example_physical_simulation(coordinates, .2, 4)
+        _, received, _, D_sparse, _, Ar = sparse_physical_simulation(
+            coordinates, .2, 4, cutoff=20, M=M
+        )
+        _, _, _, _, _, Ar_near = sparse_physical_simulation(
+            coordinates, .2, 4, cutoff=20, far_field=False, M=M
+        )
+        self.assertLess(D_sparse.nnz, 300*299)
+        self.assertTrue(np.all(Ar >= Ar_near))
+        error = cutoff_throughput_error(coordinates, .2, 4, cutoff=20, trials=3)
+        self.assertTrue(0 <= error <= 1)
+
+    def test_sparse_far_field_accuracy(self):
+        # The quadtree far field adds what the cutoff leaves out of Ar, up to the lumping
+        coordinates = np.random.uniform(-500, 500, size=(1500, 2))
+        _, _, M, D, _, Ar = example_physical_simulation(coordinates, .1, 3)
+        for cutoff in (10, 40):
+            Ar_sparse = sparse_physical_simulation(coordinates, .1, 3, cutoff=cutoff, M=M)[5]
+            Ar_near = sparse_physical_simulation(coordinates, .1, 3, cutoff=cutoff, far_field=False, M=M)[5]
+            far = Ar - Ar_near
+            self.assertLess(np.abs(Ar_sparse - Ar).sum(), .08*far.sum())
+
+    def test_sparse_physical_silent_frame(self):
+        # no stored pair has a transmitting column, e.g. nothing sent or a single node
+        for N, M in ((40, np.zeros((40, 10), dtype=int)), (1, np.ones((1, 10), dtype=int))):
+            coordinates = np.random.normal(0, 200, (N, 2))
+            sent, received, _, _, _, Ar = sparse_physical_simulation(coordinates, K=10, M=M)
+            self.assertEqual(received, 0)
+            self.assertEqual(Ar.dtype, float)
+            np.testing.assert_array_equal(Ar, 0)
+
+
+    def test_incremental_zero_tolerance_is_exact(self):
+        layer = IncrementalPhysicalLayer(tolerance=0)
+        swarm = Swarm(N=25, hist_length=1)
+        for _ in range(10):
+            swarm.update(dt=1/30)
+            state = np.random.get_state()
+            expected = example_physical_simulation(swarm.coordinates, 1/30, 5)
+            np.random.set_state(state)
+            tot_sent, tot_rec, M, D, _, Ar = layer.step(swarm.coordinates, 1/30, 5)
+            self.assertEqual((tot_sent, tot_rec), expected[:2])
+            np.testing.assert_equal(D, expected[3])
+        self.assertEqual(layer.stats.fraction_recomputed, 1)
+
+    def test_incremental_partial_update(self):
+        coordinates = np.random.uniform(-200, 200, size=(30, 2))
+        M = (np.random.random((30, 4)) < .3).astype(int)
+        layer = IncrementalPhysicalLayer(tolerance=.5)
+        D_before = layer.step(coordinates, K=4, M=M)[3].copy()
+
+        # move two nodes past the tolerance, and the rest within it
+        moved = coordinates + np.random.uniform(-.1, .1, size=coordinates.shape)
+        moved[[3, 17]] += 5
+        tot_sent, tot_rec, _, D, _, Ar = layer.step(moved, K=4, M=M)
+        self.assertEqual(layer.stats.nodes_moved, 2)
+        self.assertEqual(layer.stats.entries_recomputed, 2 * (2*30 - 2))
+        self.assertEqual(layer.stats.Ar_update, 'low-rank')
+        np.testing.assert_allclose(Ar, D @ M)
+
+        # the pair of moved nodes is exact, and unmoved pairs are kept
+        expected_D = example_physical_simulation(moved, K=4, M=M)[3]
+        self.assertEqual(D[3, 17], expected_D[3, 17])
+        unmoved = np.setdiff1d(np.arange(30), [3, 17])
+        np.testing.assert_equal(D[np.ix_(unmoved, unmoved)], D_before[np.ix_(unmoved, unmoved)])
+
+        layer.step(moved, K=4, M=M)
+        self.assertEqual(layer.stats.nodes_moved, 0)
+        self.assertEqual(layer.stats.Ar_update, 'none')
+
+    def test_incremental_fresh_M(self):
+        # A fresh M every frame, as the callers sample it: Ar follows the changed entries
+        coordinates = np.random.uniform(-200, 200, size=(60, 2))
+        layer = IncrementalPhysicalLayer(tolerance=.5)
+        rng = np.random.default_rng(0)
+        layer.step(coordinates, 1/60, 10, rng=rng)
+        for _ in range(20):
+            coordinates[:3] += 1
+            tot_sent, tot_rec, M, D, _, Ar = layer.step(coordinates, 1/60, 10, rng=rng)
+            self.assertEqual(layer.stats.Ar_update, 'low-rank')
+            self.assertEqual(layer.stats.nodes_moved, 3)
+            expected = example_physical_simulation(coordinates, K=10, M=M)
+            # to rounding, as entries turned off leave a residual rather than an exact zero
+            np.testing.assert_allclose(Ar, expected[5], rtol=1e-9, atol=1e-15)
+            self.assertEqual(tot_rec, expected[1])
+
+    def test_incremental_full_rebuild(self):
+        # When most nodes move, D is rebuilt whole
+        coordinates = np.random.uniform(-200, 200, size=(30, 2))
+        layer = IncrementalPhysicalLayer(tolerance=1)
+        layer.step(coordinates, K=4)
+        coordinates[:20] += 2
+        _, _, M, D, _, Ar = layer.step(coordinates, K=4)
+        self.assertEqual(layer.stats.nodes_moved, 20)
+        self.assertEqual(layer.stats.fraction_recomputed, 1)
+        self.assertEqual(layer.stats.Ar_update, 'full')
+        np.testing.assert_equal(D, example_physical_simulation(coordinates, K=4, M=M)[3])
+
+
+    def test_expected_matches_enumeration(self):
+        # Small N is exact: compare with every possible M on one channel
+        N, p = 6, .3
+        coordinates = np.random.uniform(-200, 200, size=(N, 2))
+        expected = 0
+        for pattern in range(2**N):
+            M = ((pattern >> np.arange(N)) & 1)[:, None]
+            probability = p**M.sum() * (1 - p)**(N - M.sum())
+            expected += probability * example_physical_simulation(coordinates, K=1, M=M)[1]
+
+        sent, received, _, _ = expected_physical_simulation(coordinates, dt=p, K=3)
+        self.assertAlmostEqual(sent, N*3*p)
+        self.assertAlmostEqual(received, 3*expected)
+
+    def test_expected_matches_monte_carlo(self):
+        # Large N uses the approximation; check it against the Monte Carlo counter
+        rng_state = np.random.get_state()
+        np.random.seed(5)
+        coordinates = np.random.uniform(-200, 200, size=(30, 2))
+        samples = [example_physical_simulation(coordinates, .2, 20)[1] for _ in range(1000)]
+        np.random.set_state(rng_state)
+
+        _, received, _, _ = expected_physical_simulation(coordinates, .2, 20)
+        standard_error = np.std(samples) / np.sqrt(len(samples))
+        self.assertLess(abs(received - np.mean(samples)), max(5*standard_error, .01*received))
+
+    def test_expected_matches_monte_carlo_at_default_rate(self):
+        # At dt=1/60 the quieter interferers are mostly all silent
+        for N in (40, 120):
+            coordinates = Swarm(N=N, hist_length=1, rng=0).coordinates
+            rng = np.random.default_rng(1)
+            samples = [example_physical_simulation(coordinates, 1/60, 10, rng=rng)[1] for _ in range(2000)]
+
+            _, received, _, _ = expected_physical_simulation(coordinates, 1/60, 10)
+            standard_error = np.std(samples) / np.sqrt(len(samples))
+            self.assertLess(abs(received - np.mean(samples)), max(5*standard_error, .02*received))
+
+
+class ParallelTests(ut.TestCase):
+    def test_matches_example(self):
+        for workers, block in ((1, None), (3, None), (2, 1), (4, 7)):
+            N, K = np.random.randint(1, 60), np.random.randint(1, 10)
+            coordinates = np.random.normal(0, 50, (N, 2))
+            sent, received, M, D, A, Ar = example_physical_simulation(coordinates, .2, K)
+            parallel = parallel_physical_simulation(coordinates, .2, K, workers=workers, block=block, M=M)
+            self.assertEqual(parallel[0], sent)
+            self.assertEqual(parallel[1], received)
+            np.testing.assert_array_equal(parallel[3], D)
+            np.testing.assert_allclose(parallel[5], Ar, rtol=1e-12)
+            self.assertIsNone(parallel[4])
+
+    def test_simulate(self):
+        result = simulate(N=20, K=4, fps=8, total_time=1, seed=2, physical_layer=partial(parallel_physical_simulation, workers=2))
+        expected = simulate(N=20, K=4, fps=8, total_time=1, seed=2)
+        np.testing.assert_array_equal(result.received, expected.received)
+
+
+class ChunkedTests(ut.TestCase):
+    def test_matches_example(self):
+        for chunk in (1, 7, 64, 1000):
+            N, K = np.random.randint(1, 80), np.random.randint(1, 10)
+            coordinates = np.random.normal(0, 50, (N, 2))
+            sent, received, M, D, A, Ar = example_physical_simulation(coordinates, .2, K)
+            chunked = chunked_physical_simulation(coordinates, .2, K, chunk=chunk, return_Ar=True, M=M)
+            self.assertEqual(chunked[:2], (sent, received))
+            self.assertIsNone(chunked[3])
+            np.testing.assert_allclose(chunked[5], Ar, rtol=1e-12)
+            self.assertIsNone(chunked_physical_simulation(coordinates, .2, K, chunk=chunk, M=M)[5])
+
+    def test_bounded_memory(self):
+        import tracemalloc
+        N = 2000
+        coordinates = np.random.normal(0, 100, (N, 2))
+        M = (np.random.random((N, 4)) < .05).astype(int)
+        tracemalloc.start()
+        chunked_physical_simulation(coordinates, K=4, chunk=50, M=M)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        # a dense D alone would be N*N*8 = 32 MB
+        self.assertLess(peak, N*N*8 / 10)
+
+    def test_bad_chunk(self):
+        with self.assertRaises(ValueError):
+            chunked_physical_simulation(np.zeros((3, 2)), chunk=0)
+
+
+class EventTests(ut.TestCase):
+    def test_matches_example(self):
+        for dt in (.01, .1, .5, 1):
+            N, K = np.random.randint(1, 60), np.random.randint(1, 10)
+            coordinates = np.random.normal(0, 50, (N, 2))
+            sent, received, M, D, A, Ar = example_physical_simulation(coordinates, dt, K)
+            event = event_physical_simulation(coordinates, dt, K, M=M)
+            self.assertEqual(event[:2], (sent, received))
+            np.testing.assert_allclose(event[5], Ar, rtol=1e-12)
+
+    def test_columns(self):
+        coordinates = np.random.normal(0, 50, (20, 2))
+        columns = np.array([3, 0, 3, 19])
+        np.testing.assert_array_equal(
+            kernels.inverse_square_distances_columns(coordinates, columns),
+            kernels.inverse_square_distances_numpy(coordinates)[:, columns]
+        )
+
+    def test_silent_frame(self):
+        sent, received, M, D, A, Ar = event_physical_simulation(np.random.normal(0, 50, (10, 2)), K=3, M=np.zeros((10, 3), dtype=int))
+        self.assertEqual((sent, received), (0, 0))
+        np.testing.assert_array_equal(Ar, 0)
+
+    def test_simulate(self):
+        result = simulate(N=20, K=4, fps=8, total_time=1, seed=2, physical_layer=event_physical_simulation)
+        expected = simulate(N=20, K=4, fps=8, total_time=1, seed=2)
+        np.testing.assert_array_equal(result.received, expected.received)
+
+
+class StalenessTests(ut.TestCase):
+    def test_refresh_every_frame(self):
+        layer = CachedPhysicalLayer(refresh_every=1)
+        comparison = compare_physical_layers(layer.step, N=15, K=4, fps=8, total_time=2, seed=3)
+        np.testing.assert_array_equal(comparison.reduced.received, comparison.reference.received)
+        self.assertEqual(comparison.error, 0)
+        self.assertEqual(layer.stats.rebuilds, 16)
+
+    def test_budget(self):
+        layer = CachedPhysicalLayer(refresh_every=4)
+        swarm = Swarm(N=10, hist_length=1, rng=0)
+        built_from = None
+        for ti in range(10):
+            swarm.update(dt=1/8)
+            D = layer.step(swarm.coordinates, 1/8, 3, rng=ti)[3]
+            if ti % 4 == 0:
+                built_from = swarm.coordinates.copy()
+            np.testing.assert_array_equal(D, example_physical_simulation(built_from, 1/8, 3)[3])
+        self.assertEqual(layer.stats.rebuilds, 3)
+        self.assertEqual(layer.stats.frames, 10)
+
+    def test_displacement(self):
+        layer = CachedPhysicalLayer(refresh_every=None, max_displacement=1.0)
+        coordinates = np.random.normal(0, 50, (8, 2))
+        layer.step(coordinates, K=2)
+        layer.step(coordinates + .5, K=2)
+        self.assertEqual(layer.stats.rebuilds, 1)
+        layer.step(coordinates + 1, K=2)
+        self.assertEqual(layer.stats.rebuilds, 2)
+        with self.assertRaises(ValueError):
+            CachedPhysicalLayer(refresh_every=0)
+
+    def test_error_report(self):
+        comparison = compare_physical_layers(CachedPhysicalLayer(refresh_every=30).step, N=20, K=4, fps=8, total_time=4, seed=0)
+        np.testing.assert_array_equal(comparison.reduced.sent, comparison.reference.sent)
+        self.assertLess(abs(comparison.error), .1)
+
+
+class PrecisionTests(ut.TestCase):
+    def test_float32_layer(self):
+        coordinates = np.random.normal(0, 50, (30, 2))
+        sent, received, M, D, A, Ar = example_physical_simulation(coordinates, .2, 5, return_A=True, dtypes=FLOAT32)
+        self.assertEqual(M.dtype, np.uint8)
+        self.assertEqual(D.dtype, np.float32)
+        self.assertEqual(Ar.dtype, np.float32)
+        self.assertEqual(A.dtype, np.float32)
+        self.assertEqual(sent, M.sum())
+        reference = example_physical_simulation(coordinates, .2, 5, M=M.astype(int))
+        # close pairs lose digits to cancellation in the float32 differences,
+        # up to about 4e-5 relative for these coordinates
+        np.testing.assert_allclose(D, reference[3], rtol=1e-4)
+        self.assertLessEqual(abs(received - reference[1]), 2)
+
+    def test_swarm_dtype(self):
+        swarm = Swarm(N=5, hist_length=3, rng=0, dtype=np.float32)
+        reference = Swarm(N=5, hist_length=3, rng=0)
+        for _ in range(4):
+            swarm.update()
+            reference.update()
+        self.assertEqual(swarm.history().dtype, np.float32)
+        # the polar state stays float64, so only the stored positions are rounded
+        np.testing.assert_array_equal(swarm.r, reference.r)
+        np.testing.assert_array_equal(swarm.history(), reference.history().astype(np.float32))
+
+    def test_compare_precision(self):
+        comparison = compare_precision(N=30, K=5, fps=8, total_time=2, seed=1)
+        self.assertEqual(comparison.reference.frames, comparison.reduced.frames)
+        np.testing.assert_array_equal(comparison.reference.sent, comparison.reduced.sent)
+        self.assertLess(abs(comparison.error), 1e-3)
+        self.assertLessEqual(comparison.frames_differing, comparison.reference.frames)
+
+
+class KernelTests(ut.TestCase):
+    def test_backend(self):
+        self.assertIn(kernels.BACKEND, ('numba', 'numpy'))
+
+    def test_distances_match(self):
+        for _ in range(10):
+            N = np.random.randint(1, 40)
+            coordinates = np.random.normal(0, 50, (N, 2))
+            np.testing.assert_array_equal(
+                kernels.inverse_square_distances_loop(coordinates),
+                kernels.inverse_square_distances_numpy(coordinates)
+            )
+
+    def test_coincident_nodes(self):
+        coordinates = np.array([[0., 0.], [0., 0.], [3., 4.]])
+        with np.errstate(divide='ignore'):
+            D = kernels.inverse_square_distances_numpy(coordinates)
+        np.testing.assert_array_equal(kernels.inverse_square_distances_loop(coordinates), D)
+        self.assertEqual(D[0, 1], np.inf)
+
+    def test_receptions_match(self):
+        for _ in range(20):
+            N, K = np.random.randint(1, 40), np.random.randint(1, 10)
+            coordinates = np.random.normal(0, 50, (N, 2))
+            D = kernels.inverse_square_distances_numpy(coordinates)
+            M = (np.random.random((N, K)) < .3).astype(int)
+            Ar = D @ M
+            self.assertEqual(
+                kernels.count_receptions_loop(D, M, Ar),
+                kernels.count_receptions_numpy(D, M, Ar)
+            )
+            self.assertEqual(
+                kernels.count_receptions(D, M, Ar),
+                kernels.count_receptions_numpy(D, M, Ar)
+            )
+
+
+class BlockedDistanceTests(ut.TestCase):
+    def test_matches_numpy(self):
+        for block in (1, 7, 64, 256):
+            N = np.random.randint(1, 150)
+            coordinates = np.random.normal(0, 200, (N, 2))
+            D = kernels.inverse_square_distances_blocked(coordinates, block=block)
+            np.testing.assert_allclose(D, kernels.inverse_square_distances_numpy(coordinates), rtol=1e-6)
+            np.testing.assert_array_equal(D, D.T)
+            np.testing.assert_array_equal(np.diag(D), 0)
+
+    def test_coincident_nodes(self):
+        coordinates = np.array([[0., 0.], [0., 0.], [3., 4.]])
+        D = kernels.inverse_square_distances_blocked(coordinates, min_distance=.1)
+        self.assertTrue(np.isfinite(D).all())
+        self.assertAlmostEqual(D[0, 1], 100)
+        self.assertAlmostEqual(D[0, 2], 1/25)
+        # and the physical layer stays finite too
+        Ar = example_physical_simulation(coordinates, 1, 2, distances=kernels.inverse_square_distances_blocked)[5]
+        self.assertTrue(np.isfinite(Ar).all())
+
+    def test_physical_layer(self):
+        coordinates = np.random.normal(0, 200, (60, 2))
+        sent, received, M = example_physical_simulation(coordinates, .2, 5)[:3]
+        blocked = example_physical_simulation(coordinates, .2, 5, M=M, distances=partial(kernels.inverse_square_distances_blocked, block=16))
+        self.assertEqual(blocked[:2], (sent, received))
+        self.assertEqual(kernels.inverse_square_distances_blocked(coordinates, np.float32).dtype, np.float32)
+
+    def test_float32_accuracy(self):
+        # close pairs decide receptions, so float32 must not lose them to cancellation
+        coordinates = Swarm(N=1000, hist_length=1, rng=0).coordinates
+        D = kernels.inverse_square_distances_blocked(coordinates, np.float32)
+        self.assertEqual(D.dtype, np.float32)
+        np.testing.assert_allclose(D, kernels.inverse_square_distances_numpy(coordinates), rtol=1e-6)
+
+
+class DrawTests(ut.TestCase):
+    def test_draw_M_matches_per_cell(self):
+        # The vectorized heatmap should give the same pixels as drawing each cell
+        import pygame
+        for border in (0, 1):
+            M = np.random.random((np.random.randint(1, 30), np.random.randint(1, 30)))
+            screen = pygame.Surface((200, 200))
+            expected = pygame.Surface((200, 200))
+            screen.fill(S16.black)
+            expected.fill(S16.black)
+
+            draw_M(M, screen, corner=(5, 7), border=border, C1=S16.orange)
+            for ii in range(M.shape[0]):
+                for kk in range(M.shape[1]):
+                    pygame.draw.rect(
+                        expected,
+                        interpolate_color(S16.orange, S16.black, 1 - M[ii,kk]),
+                        (5 + (3+border)*ii, 7 + (3+border)*kk, 3, 3)
+                    )
+            np.testing.assert_equal(
+                pygame.surfarray.array3d(screen),
+                pygame.surfarray.array3d(expected)
+            )
+
+
+class PhaseTimerTests(ut.TestCase):
+    def test_rolling_average(self):
+        timer = PhaseTimer(window=3)
+        for _ in range(5):
+            with timer.phase('a'):
+                pass
+            with timer.phase('b'):
+                sum(range(1000))
+        averages = timer.averages()
+        self.assertEqual(list(averages), ['a', 'b'])
+        self.assertEqual(len(timer._phases['a'].samples), 3)
+        self.assertEqual(timer._phases['a'].count, 5)
+        self.assertTrue(all(average > 0 for average in averages.values()))
+        self.assertEqual(len(timer.lines()), 2)
+        self.assertIn("| b | 5 |", timer.report())
+
+    def test_disabled(self):
+        timer = PhaseTimer(enabled=False)
+        with timer.phase('a'):
+            pass
+        self.assertEqual(timer.averages(), {})
+        self.assertIs(timer.phase('a'), timer.phase('b'))
+
+    def test_main_profile(self):
+        main(N=6, K=3, fps=8, total_time=1, ratelimit=False, profile=True)
+        main(N=6, K=3, fps=8, total_time=1, ratelimit=False, profile=True, threaded=True)
+
+
 class PaletteTests(ut.TestCase):
     def test_sanity_s16_raw(self):
         self.assertEqual(s16_raw.shape, (16, 3))
@@ -135,6 +789,253 @@ class PaletteTests(ut.TestCase):
                     interpolate_color(color1, color2, r=1)
                 )
 
+class SimulationTests(ut.TestCase):
+    def test_simulate_counters(self):
+        # dt = 1/8 is exact, so there are no rounding leftovers in tt
+        result = simulate(N=12, K=5, fps=8, total_time=2)
+        self.assertEqual(result.frames, 16)
+        self.assertEqual(result.sent.shape, result.received.shape)
+        self.assertEqual(
+            result.throughput,
+            broadcast_throughput(result.received.sum(), result.sent.sum(), 12)
+        )
+
+    def test_simulate_seeded(self):
+        first = simulate(N=10, K=4, fps=20, total_time=1, seed=3)
+        second = simulate(N=10, K=4, fps=20, total_time=1, seed=3)
+        np.testing.assert_equal(first.received, second.received)
+        np.testing.assert_equal(first.sent, second.sent)
+
+    def test_simulate_replicas(self):
+        results = simulate_replicas(R=4, N=10, K=3, fps=8, total_time=2, seed=0)
+        self.assertEqual(len(results), 4)
+        for result in results:
+            self.assertEqual(result.frames, 16)
+            self.assertTrue(0 <= result.throughput <= 1)
+        # replicas are independent
+        self.assertFalse(all(
+            np.array_equal(results[0].sent, result.sent) for result in results[1:]
+        ))
+
+    def test_simulate_physical_layer(self):
+        result = simulate(
+            N=30, K=4, fps=8, total_time=1, seed=1,
+            physical_layer=partial(sparse_physical_simulation, cutoff=40)
+        )
+        self.assertEqual(result.frames, 8)
+
+    def test_simulate_expected(self):
+        result = simulate(
+            N=10, K=4, fps=8, total_time=1, seed=1,
+            physical_layer=expected_physical_simulation
+        )
+        np.testing.assert_allclose(result.sent, 10*4/8)
+        self.assertTrue(0 < result.throughput <= 1)
+
+    def test_simulate_never_imports_pygame(self):
+        code = (
+            "import sys, simulation; "
+            "simulation.simulate(N=5, K=3, fps=10, total_time=.5); "
+            "assert 'pygame' not in sys.modules"
+        )
+        subprocess.run([sys.executable, "-c", code], check=True)
+
+    def test_throughput_edgecases(self):
+        self.assertTrue(np.isnan(broadcast_throughput(0, 0, 10)))
+        self.assertTrue(np.isnan(broadcast_throughput(0, 5, 1)))
+        self.assertEqual(broadcast_throughput(9, 1, 10), 1.0)
+
+
+class TrajectoryTests(ut.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "trajectory.npy")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_record(self):
+        trajectory = record_trajectory(self.path, N=9, fps=8, total_time=2, seed=4)
+        self.assertEqual(trajectory.shape, (16, 9, 2))
+        self.assertEqual(trajectory.dtype, np.float32)
+        # Same swarm as a Swarm with the same seed
+        swarm = Swarm(N=9, hist_length=1, rng=np.random.default_rng(4))
+        for frame in trajectory:
+            swarm.update(dt=1/8)
+            np.testing.assert_array_equal(frame, swarm.coordinates.astype(np.float32))
+
+    def test_replay(self):
+        trajectory = record_trajectory(self.path, N=10, fps=8, total_time=2, seed=0)
+        result = replay_trajectory(self.path, K=4, fps=8, seed=1)
+        self.assertEqual(result.frames, 16)
+        # Same as running the physical layer over each frame by hand
+        rng = np.random.default_rng(1)
+        for ti, frame in enumerate(trajectory):
+            sent, received = example_physical_simulation(frame, 1/8, 4, rng=rng)[:2]
+            self.assertEqual(result.sent[ti], sent)
+            self.assertEqual(result.received[ti], received)
+        # An array works too
+        in_memory = replay_trajectory(np.array(trajectory), K=4, fps=8, seed=1)
+        np.testing.assert_array_equal(in_memory.received, result.received)
+
+    def test_replay_sweep_K(self):
+        record_trajectory(self.path, N=10, fps=8, total_time=1, seed=0)
+        for K in (1, 5, 20):
+            result = replay_trajectory(self.path, K=K, fps=8, seed=K)
+            self.assertEqual(result.K, K)
+            self.assertTrue(0 <= result.throughput <= 1 or np.isnan(result.throughput))
+
+
+class MetricsTests(ut.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "metrics.npy")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_reception_counts(self):
+        for _ in range(5):
+            N, K = np.random.randint(2, 30), np.random.randint(1, 10)
+            coordinates = np.random.normal(0, 30, (N, 2))
+            _, received, M, D, _, Ar = example_physical_simulation(coordinates, .3, K)
+            per_channel, per_node = reception_counts(D, M, Ar)
+            self.assertEqual(per_channel.shape, (K,))
+            self.assertEqual(per_node.shape, (N,))
+            self.assertEqual(per_channel.sum(), received)
+            self.assertEqual(per_node.sum(), received)
+
+    def test_simulate_metrics(self):
+        # Smaller buffer than the run, so records are written in several blocks
+        result = simulate(N=12, K=4, fps=10, total_time=3, seed=5, metrics=self.path, metrics_per_node=True)
+        records = read_metrics(self.path)
+        self.assertEqual(len(records), result.frames)
+        np.testing.assert_array_equal(records['sent'], result.sent)
+        np.testing.assert_array_equal(records['received'], result.received)
+        np.testing.assert_allclose(records['time'], np.arange(1, result.frames + 1) / 10)
+        np.testing.assert_array_equal(records['channel_sent'].sum(axis=1), result.sent)
+        np.testing.assert_array_equal(records['channel_received'].sum(axis=1), result.received)
+        np.testing.assert_array_equal(records['node_sent'].sum(axis=1), result.sent)
+        np.testing.assert_array_equal(records['node_received'].sum(axis=1), result.received)
+        # Metrics don't change the run
+        self.assertEqual(simulate(N=12, K=4, fps=10, total_time=3, seed=5).throughput, result.throughput)
+
+    def test_writer_blocks(self):
+        with MetricsWriter(self.path, K=2, buffer=3) as writer:
+            for ii in range(7):
+                writer.record(ii, ii, 2*ii, M=np.ones((4, 2)))
+        records = np.load(self.path)
+        self.assertEqual(records.dtype.names, ('time', 'sent', 'received', 'channel_sent', 'channel_received'))
+        np.testing.assert_array_equal(records['received'], 2*np.arange(7))
+        np.testing.assert_array_equal(records['channel_sent'], 4)
+        # D and Ar weren't given
+        np.testing.assert_array_equal(records['channel_received'], 0)
+
+    def test_main_metrics(self):
+        main(N=6, K=3, fps=8, total_time=1, simplify_render=True, ratelimit=False, metrics=self.path)
+        self.assertEqual(len(read_metrics(self.path)), 8)
+        main(N=6, K=3, fps=8, total_time=1, threaded=True, ratelimit=False, metrics=self.path)
+        self.assertEqual(len(read_metrics(self.path)), 8)
+
+
+class AggregatorTests(ut.TestCase):
+    def test_normal_quantile(self):
+        from simulation import _normal_quantile
+        for q, z in ((.5, 0), (.975, 1.959963984540054), (.995, 2.5758293035489004), (1e-10, -6.361340902404056)):
+            self.assertAlmostEqual(_normal_quantile(q), z, places=9)
+        self.assertAlmostEqual(ThroughputAggregator(10, confidence=.95)._z, 1.959963984540054, places=12)
+
+    def test_matches_batch_statistics(self):
+        N, batch = 12, 3
+        sent = np.random.randint(0, 10, 30)
+        received = np.random.randint(0, 50, 30)
+        aggregator = ThroughputAggregator(N, batch=batch)
+        for frame_sent, frame_received in zip(sent, received):
+            aggregator.add(frame_sent, frame_received)
+        self.assertEqual(aggregator.throughput, broadcast_throughput(received.sum(), sent.sum(), N))
+        self.assertEqual(aggregator.batches, 10)
+        # delta-method standard error of the ratio of batch means
+        x = sent.reshape(-1, batch).sum(axis=1) * (N - 1)
+        y = received.reshape(-1, batch).sum(axis=1)
+        ratio = y.mean() / x.mean()
+        se = np.std(y - ratio*x, ddof=1) / np.sqrt(len(x)) / x.mean()
+        self.assertAlmostEqual(aggregator.half_width, 1.959963984540054 * se)
+        low, high = aggregator.interval()
+        self.assertAlmostEqual((low + high) / 2, aggregator.throughput)
+
+    def test_not_converged_early(self):
+        aggregator = ThroughputAggregator(5, min_batches=4)
+        self.assertEqual(aggregator.half_width, np.inf)
+        for _ in range(3):
+            aggregator.add(10, 20)
+        # no variance, but too few batches
+        self.assertFalse(aggregator.converged(1))
+        aggregator.add(10, 20)
+        self.assertTrue(aggregator.converged(1))
+
+    def test_simulate_early_stop(self):
+        full = simulate(N=10, K=4, fps=8, total_time=60, seed=0)
+        early = simulate(N=10, K=4, fps=8, total_time=60, seed=0, target_width=.2)
+        self.assertLess(early.frames, full.frames)
+        self.assertGreaterEqual(early.frames, 10*8)
+        # same run, just cut short
+        np.testing.assert_array_equal(early.received, full.received[:early.frames])
+        never = simulate(N=10, K=4, fps=8, total_time=2, seed=0, target_width=1e-9)
+        self.assertEqual(never.frames, 16)
+
+    def test_sweep_early_stop(self):
+        results = run_sweep(Ns=[6], Ks=[3], fpses=[8], Ts=[60], seeds=range(2), workers=1, target_width=.5)
+        self.assertTrue(np.all(results[0].simulated_times < 60))
+        self.assertIn("simulated T", markdown_table(results, columns=('N', 'simulated')))
+
+
+class SweepTests(ut.TestCase):
+    def test_sweep_serial_matches_pool(self):
+        kwargs = dict(Ns=[4, 8], Ks=[3], fpses=[10], Ts=[.5], seeds=[0, 1])
+        serial = run_sweep(workers=1, **kwargs)
+        pooled = run_sweep(workers=2, **kwargs)
+        self.assertEqual([res.N for res in serial], [4, 8])
+        for res_s, res_p in zip(serial, pooled):
+            np.testing.assert_equal(res_s.throughputs, res_p.throughputs)
+            self.assertEqual(len(res_s.throughputs), 2)
+
+    def test_sweep_markdown(self):
+        results = run_sweep(Ns=[4], Ks=[3], fpses=[10, 20], Ts=[.5], workers=1)
+        table = markdown_table(results, columns=('fps', 'dt')).splitlines()
+        self.assertEqual(table[0], "| FPS | dt | throughput |")
+        self.assertEqual(table[1], "| --- | -- | ---------- |")
+        self.assertEqual(len(table), 4)
+        self.assertTrue(table[2].startswith("| 10 | 0.100 | "))
+
+
+class BenchmarkTests(ut.TestCase):
+    def test_grid(self):
+        results = run_benchmarks(Ns=(4, 8), Ks=(2,), hist_lengths=(1, 3), repeats=2, min_time=0)
+        names = [result.name for result in results]
+        # N x hist_length, N x K, N x K, N x hist_length
+        self.assertEqual(names.count('swarm_update'), 4)
+        self.assertEqual(names.count('physical'), 2)
+        self.assertEqual(names.count('draw_M'), 2)
+        self.assertEqual(names.count('draw_tail'), 4)
+        for result in results:
+            self.assertTrue(0 < result.best <= result.mean)
+            if result.name == 'physical':
+                self.assertIsNone(result.hist_length)
+
+    def test_save_load_compare(self):
+        results = run_benchmarks(Ns=(4,), Ks=(2,), hist_lengths=(2,), names=('physical', 'swarm_update'), repeats=1, min_time=0)
+        with tempfile.TemporaryDirectory() as tmp:
+            for fn in ("baseline.json", "baseline.csv"):
+                path = os.path.join(tmp, fn)
+                save_results(results, path)
+                self.assertEqual(load_results(path), results)
+        _, regressions = compare(results, results)
+        self.assertEqual(regressions, [])
+        faster = [replace(result, best=result.best / 2) for result in results]
+        _, regressions = compare(results, faster, threshold=.5)
+        self.assertEqual(regressions, results)
+
+
 class MainTests(ut.TestCase):
     def test_sanity_main(self):
         for _ in range(10):
@@ -170,7 +1071,34 @@ class MainTests(ut.TestCase):
             total_time = .5,
             ratelimit = False
         )
-                
+
+    def test_threaded_main(self):
+        # Fixed-step simulation on the worker, so same result as lockstep
+        kwargs = dict(N=10, K=5, fps=30, total_time=1, ratelimit=False, seed=3)
+        self.assertEqual(main(**kwargs), main(threaded=True, **kwargs))
+        main(threaded=True, simplify_render=True, N=5, K=3, fps=20, total_time=.5, seed=1)
+
+    def test_lockstep_metrics_closed_on_error(self):
+        # The metrics file is finalized even if the lockstep loop raises
+        import main as main_module
+        physical = main_module.example_physical_simulation
+        calls = []
+        def failing(*args, **kwargs):
+            calls.append(None)
+            if len(calls) > 5:
+                raise RuntimeError("physical layer failed")
+            return physical(*args, **kwargs)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'run.npy')
+            with ut.mock.patch.object(main_module, 'example_physical_simulation', failing):
+                with self.assertRaises(RuntimeError):
+                    main(N=5, K=3, fps=10, total_time=2, ratelimit=False, seed=0, metrics=path)
+            records = read_metrics(path)
+            self.assertEqual(len(records), 5)
+            self.assertEqual(records['channel_sent'].dtype.base, records['channel_received'].dtype.base)
+            del records
+
 
 
 
@@ -1,9 +1,18 @@
-import math
 import numpy as np
-import pygame
 from palette import interpolate_color, S16
+from kernels import inverse_square_distances as _inverse_square_distances
+from kernels import count_receptions as _count_receptions
+from kernels import count_receptions_batched as _count_receptions_batched
+from collections import deque
+from contextlib import nullcontext
+from dataclasses import dataclass
+from functools import lru_cache
+from time import perf_counter
 from typing import List, Tuple
 
+# pygame is only imported by the drawing functions,
+# so the simulation can run headless without it.
+
 def polar_to_xy(r: float, theta: float = 0):
     """Convert polar coordinates in (r, theta) to cartesian (x, y).
 
@@ -35,6 +44,214 @@ def center_origin(coord, width=360, height=360):
     """
     return (coord[0] + width/2, coord[1] + width/2)
 
+def as_rng(rng = None):
+    """Random number source for a `rng` argument.
+
+    None gives numpy's global random state (np.random), as before seeding existed.
+    Anything else goes through np.random.default_rng, so an int seed,
+    a SeedSequence, or a Generator (passed through as-is) all work.
+    An int seed starts a fresh stream on every call, so pass one
+    Generator around for draws that should continue a stream.
+
+    :param rng: Seed or generator, defaults to None
+    :type rng: int, np.random.SeedSequence or np.random.Generator, optional
+    :return: Object with the Generator sampling methods (random, normal, uniform)
+    :rtype: np.random.Generator or module
+    """
+    if rng is None or rng is np.random:
+        return np.random
+    return np.random.default_rng(rng)
+
+@dataclass(frozen=True)
+class DtypePolicy:
+    '''
+    Dtypes for the arrays of the simulation.
+
+    distance is used for D, Ar and A, message for M,
+    and position for the Swarm history buffer.
+    '''
+    distance: type = np.float64
+    message: type = np.int64
+    position: type = np.float64
+
+
+# Defaults, as before dtype policies existed
+FLOAT64 = DtypePolicy()
+# Half the memory traffic. uint8 M keeps D @ M in float32 (int64 would upcast it)
+FLOAT32 = DtypePolicy(distance=np.float32, message=np.uint8, position=np.float32)
+
+
+def default_drift(r):
+    """Radial velocity per the paper, without the noise term.
+
+    :param r: Radii, any shape
+    :type r: np.ndarray
+    :return: dr/dt, same shape as r
+    :rtype: np.ndarray
+    """
+    return (100 - r)/100 + (3/2)*np.cos(r*np.pi/3)
+
+def default_drdt(r, rng = None):
+    """Radial velocity per the paper, with one noise sample per node.
+
+    :param r: Radii, any shape
+    :type r: np.ndarray
+    :param rng: Random source for the noise term, defaults to None (see as_rng)
+    :type rng: np.random.Generator, optional
+    :return: dr/dt, same shape as r
+    :rtype: np.ndarray
+    """
+    return default_drift(r) + as_rng(rng).normal(0, 30, np.shape(r))
+
+def default_dthetadt(r):
+    """Angular velocity per the paper.
+
+    :param r: Radii, any shape
+    :type r: np.ndarray
+    :return: dtheta/dt, same shape as r
+    :rtype: np.ndarray
+    """
+    return (20000 / r**2)
+
+def polar_step(x, y, dt = 1/60, drdt = default_drdt, dthetadt = default_dthetadt):
+    """Advance positions by one Euler step of the polar equations of motion.
+
+    Works elementwise, so x and y can be (N,) for one swarm
+    or (R, N) for R swarms at once.
+
+    :param x: x-coordinates
+    :type x: np.ndarray
+    :param y: y-coordinates, same shape as x
+    :type y: np.ndarray
+    :param dt: Timestep, defaults to 1/60
+    :type dt: float, optional
+    :param drdt: Function that updates r, defaults to default_drdt
+    :type drdt: Function, optional
+    :param dthetadt: Function that updates theta, defaults to default_dthetadt
+    :type dthetadt: Function, optional
+    :return: New r, theta, x, y
+    :rtype: Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]
+    """
+    # convert to polar
+    r = (x**2 + y**2)**.5
+    theta = np.arctan2(y, x)
+
+    # differential equations defining motion
+    r = r + drdt(r) * dt
+    theta = theta + dthetadt(r) * dt
+    return (r, theta) + polar_to_xy(r, theta)
+
+def _heun(r, theta, dt, substeps, drdt, dthetadt):
+    # `substeps` Heun (explicit trapezoid) steps of size dt/substeps
+    h = dt / substeps
+    for _ in range(substeps):
+        k1_r, k1_theta = drdt(r), dthetadt(r)
+        r_euler = r + h*k1_r
+        k2_r, k2_theta = drdt(r_euler), dthetadt(r_euler)
+        r, theta = r + h/2*(k1_r + k2_r), theta + h/2*(k1_theta + k2_theta)
+    return r, theta
+
+def adaptive_polar_step(
+    x,
+    y,
+    dt = 1/60,
+    drdt = default_drift,
+    dthetadt = default_dthetadt,
+    tolerance: float = 1e-2,
+    max_substeps: int = 256
+):
+    """Advance positions by dt, substepping until the error is below tolerance.
+
+    Integrates with Heun's method, doubling the number of substeps until
+    two successive solutions differ by at most tolerance (in position units)
+    for every node, or max_substeps is reached; the last doubling is
+    clamped to max_substeps. The substep count is chosen
+    once for all nodes, so each substep is a vectorized update.
+
+    drdt is called at every substep, so it should be deterministic.
+    Add noise that is held over the frame, e.g.
+    drdt = lambda r: default_drift(r) + noise.
+
+    :param x: x-coordinates
+    :type x: np.ndarray
+    :param y: y-coordinates, same shape as x
+    :type y: np.ndarray
+    :param dt: Timestep, defaults to 1/60
+    :type dt: float, optional
+    :param drdt: Function that updates r, defaults to default_drift
+    :type drdt: Function, optional
+    :param dthetadt: Function that updates theta, defaults to default_dthetadt
+    :type dthetadt: Function, optional
+    :param tolerance: Largest acceptable position error per step, defaults to 1e-2
+    :type tolerance: float, optional
+    :param max_substeps: Most substeps to take, defaults to 256
+    :type max_substeps: int, optional
+    :return: New r, theta, x, y, and the number of substeps taken
+    :rtype: Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, int]
+    """
+    if max_substeps < 1:
+        raise ValueError(f"max_substeps must be at least 1, got {max_substeps}")
+
+    r = (x**2 + y**2)**.5
+    theta = np.arctan2(y, x)
+
+    substeps = 1
+    fine = _heun(r, theta, dt, substeps, drdt, dthetadt)
+    while substeps < max_substeps:
+        coarse = fine
+        substeps = min(2*substeps, max_substeps)
+        fine = _heun(r, theta, dt, substeps, drdt, dthetadt)
+        # radial and arc-length difference between the two solutions
+        error = np.hypot(fine[0] - coarse[0], fine[0] * (fine[1] - coarse[1]))
+        if np.max(error, initial=0) <= tolerance:
+            break
+
+    r, theta = fine
+    return (r, theta) + polar_to_xy(r, theta) + (substeps,)
+
+# Background color of sprites, keyed out when blitting
+_COLORKEY = (255, 0, 255)
+
+@lru_cache(maxsize=None)
+def _circle_sprite(color: Tuple[int, int, int], radius: int):
+    """A pre-rendered circle, to blit instead of calling pygame.draw.circle.
+
+    Blit it at (x - radius, y - radius) to center it on (x, y).
+
+    :param color: RGB color
+    :type color: Tuple[int, int, int]
+    :param radius: Radius in pixels
+    :type radius: int
+    :return: Color-keyed sprite of size (2*radius, 2*radius)
+    :rtype: pygame.Surface
+    """
+    import pygame
+
+    sprite = pygame.Surface((2*radius, 2*radius))
+    sprite.fill(_COLORKEY)
+    pygame.draw.circle(sprite, color, (radius, radius), radius)
+    sprite.set_colorkey(_COLORKEY, pygame.RLEACCEL)
+    return sprite
+
+@lru_cache(maxsize=None)
+def _tail_sprites(hist_length: int):
+    """Sprite and radius of each tail segment, fading from the node outwards.
+
+    Segment ii is drawn at history position ii, for ii < hist_length - 1.
+
+    :param hist_length: Length of the node history
+    :type hist_length: int
+    :return: (sprite, radius) per segment
+    :rtype: Tuple[Tuple[pygame.Surface, int], ...]
+    """
+    segments = []
+    for ii in range(hist_length - 1):
+        alpha = (ii + 1) / hist_length
+        color = interpolate_color(S16.cyan, S16.livid_darkest, alpha)
+        radius = 2 + (ii // 6) # cheap quick hack; dependent on dt!
+        segments.append((_circle_sprite(tuple(int(cc) for cc in color[:3]), radius), radius))
+    return tuple(segments)
+
 class Node:
     def __init__(
         self,
@@ -93,29 +310,13 @@ class Node:
         
         assert self.hist_length == len(self.X) == len(self.Y)
 
-        # draw tail
-        for ii in range(self.hist_length - 1):
-            alpha = (ii + 1) / self.hist_length
-            color = interpolate_color(S16.cyan, S16.livid_darkest, alpha)
-            # Quick fix: The line made the nodes look a certain way.
-            # Let's change that here...
-            '''
-            pygame.draw.line(
-                screen,
-                color,
-                transform((self.X[ii], self.Y[ii])),
-                transform((self.X[ii + 1], self.Y[ii + 1])),
-                width = 2
-            )
-            '''
-            pygame.draw.circle(
-                screen,
-                color,
-                transform((self.X[ii], self.Y[ii])),
-                radius = 2 + (ii // 6) # cheap quick hack; dependent on dt!
-            )
+        # draw tail, from cached sprites in one batch
+        blit_sequence = []
+        for ii, (sprite, radius) in enumerate(_tail_sprites(self.hist_length)):
+            x, y = transform((self.X[ii], self.Y[ii]))
+            blit_sequence.append((sprite, (x - radius, y - radius)))
+        screen.blits(blit_sequence, doreturn=False)
 
-    
     def draw(self, screen = None, transform = lambda x: x):
         """Draw the node as a circle
 
@@ -129,87 +330,219 @@ class Node:
         if screen is None:
             screen = self.screen
         
-        pygame.draw.circle(
-            screen,
-            S16.white,
-            center = transform((self.X[0], self.Y[0])),
-            radius = 2
-        )
+        x, y = transform((self.X[0], self.Y[0]))
+        screen.blit(_circle_sprite(tuple(S16.white[:3]), 2), (x - 2, y - 2))
 
 
 
+class _HistoryView:
+    """Read-only view of one coordinate of one node's history in a Swarm.
+
+    Indexes newest-first like Node.X and Node.Y, so view[0] is the
+    current position. Slicing returns a list.
+    """
+    __slots__ = ('_swarm', '_index', '_axis')
+
+    def __init__(self, swarm, index: int, axis: int):
+        self._swarm = swarm
+        self._index = index
+        self._axis = axis
+
+    def __len__(self):
+        return self._swarm.hist_length
+
+    def __getitem__(self, key):
+        length = len(self)
+        if isinstance(key, slice):
+            return [self[ii] for ii in range(*key.indices(length))]
+        if key < 0:
+            key += length
+        if not 0 <= key < length:
+            raise IndexError("history index out of range")
+        row = (self._swarm._head - key) % length
+        return self._swarm._history[row, self._index, self._axis]
+
+    def __iter__(self):
+        return (self[ii] for ii in range(len(self)))
+
+
+class _NodeView(Node):
+    """A lightweight Node backed by the arrays of a Swarm.
+
+    X and Y read straight from the swarm's ring buffer, so
+    the draw methods of Node work unchanged.
+    """
+    def __init__(self, swarm, index: int):
+        self._swarm = swarm
+        self.X = _HistoryView(swarm, index, 0)
+        self.Y = _HistoryView(swarm, index, 1)
+
+    @property
+    def hist_length(self):
+        return self._swarm.hist_length
+
+    @property
+    def screen(self):
+        return self._swarm.screen
+
+    def update(self, x: int = 0, y: int = 0, dt = 1/60):
+        # The history belongs to the swarm, so a single node can't be moved
+        raise TypeError(
+            "Nodes of a Swarm are read-only views; their positions are "
+            "advanced together with Swarm.update"
+        )
+
+
 class Swarm:
     def __init__(
         self,
-        get_radius = lambda: np.random.normal(200, 30),
+        get_radius = None,
         N: int = 0,
-        get_theta  = lambda: np.random.uniform(0, 2*np.pi),
+        get_theta  = None,
         hist_length = 40,
-        screen = None
+        screen = None,
+        rng = None,
+        dtype = np.float64,
+        tolerance: float = None,
+        max_substeps: int = 256,
+        noise_dt: float = 1/60
     ):
         """A collection of N nodes.
 
+        State is kept as arrays: the polar state r and theta with shape (N,),
+        and the position history in a (hist_length, N, 2) ring buffer.
+        `nodes` gives per-node views, so nodes[i].X[0] is still the
+        current x-coordinate of node i.
+
         :param N: Number of nodes, defaults to 20
         :type N: int, optional
         :param get_radius: Function to choose radius to initialize nodes on,
-            defaults to lambda:np.random.normal(200, 30)
+            called once per node. Defaults to None, drawing all radii at once
+            from normal(200, 30)
         :type get_radius: function, optional
         :param get_theta: Function to choose angle to initialize nodes on,
-            defaults to lambda:np.random.uniform(0, 2*np.pi)
+            called once per node. Defaults to None, drawing all angles at once
+            from uniform(0, 2*pi)
         :type get_theta: _type_, optional
         :param hist_length: Number of coordinates to store per node, defaults to 40
         :type hist_length: int, optional
         :param screen: Display to draw to, defaults to None
         :type screen: pygame.Surface, optional
+        :param rng: Seed or generator for the initial positions and the motion noise,
+            defaults to None (numpy's global random state, see as_rng)
+        :type rng: int or np.random.Generator, optional
+        :param dtype: Dtype of the position history, e.g. FLOAT32.position.
+            The polar state r, theta is always float64. Defaults to np.float64
+        :type dtype: type, optional
+        :param tolerance: Integrate each update with adaptive_polar_step to this
+            position error, instead of one Euler step. Defaults to None (Euler)
+        :type tolerance: float, optional
+        :param max_substeps: Most substeps per update, with tolerance, defaults to 256
+        :type max_substeps: int, optional
+        :param noise_dt: With tolerance, the timestep the default noise is drawn at.
+            Each update's noise has the spread of the sum of its noise_dt steps,
+            so the motion's statistics don't depend on dt. Defaults to 1/60
+        :type noise_dt: float, optional
         """
+        if hist_length < 1:
+            raise ValueError(f"hist_length must be at least 1, got {hist_length}")
 
+        self.rng = as_rng(rng)
         self._get_radius = get_radius
         self._get_theta = get_theta
         self.hist_length = hist_length
         self.screen = screen
+        self.tolerance = tolerance
+        self.max_substeps = max_substeps
+        self.noise_dt = noise_dt
+        # substeps taken by the last update
+        self.substeps = 0
 
         # Instantiate nodes
-        self.nodes = []
-        for _ in range(N):
-            x, y = polar_to_xy(
-                r = self._get_radius(),
-                theta = self._get_radius()
-            )
-            new_node = Node(x=x, y=y, hist_length=hist_length)
-            self.nodes.append(new_node)
+        if get_radius is None:
+            r = self.rng.normal(200, 30, N)
+        else:
+            r = np.array([get_radius() for _ in range(N)], dtype=float)
+        if get_theta is None:
+            theta = self.rng.uniform(0, 2*np.pi, N)
+        else:
+            theta = np.array([get_theta() for _ in range(N)], dtype=float)
+        positions = np.stack(polar_to_xy(r, theta), axis=-1).reshape(N, 2)
+
+        # _history[_head] = current positions; older rows follow backwards
+        self._history = np.repeat(positions[None].astype(dtype), hist_length, axis=0)
+        self._head = 0
+        # full-precision current positions, integrated from, whatever the history dtype
+        self._positions = positions
+        self.r = (positions[:, 0]**2 + positions[:, 1]**2)**.5
+        self.theta = np.arctan2(positions[:, 1], positions[:, 0])
+
+        self.nodes = [_NodeView(self, ii) for ii in range(N)]
+
+    @property
+    def N(self):
+        """Number of nodes in the swarm."""
+        return self._history.shape[1]
+
+    @property
+    def coordinates(self):
+        """Current positions as an (N, 2) array.
+
+        This is a view into the history buffer, valid until the next update.
+        """
+        return self._history[self._head]
+
+    def history(self):
+        """Position history, newest first.
+
+        :return: Array of shape (hist_length, N, 2), where [0] is the current position
+        :rtype: np.ndarray
+        """
+        rows = (self._head - np.arange(self.hist_length)) % self.hist_length
+        return self._history[rows]
 
     def update(
         self,
         dt = 1/60,
-        drdt = lambda r: (100 - r)/100 + (3/2)*np.cos(r*np.pi/3) + np.random.normal(0, 30),
-        dthetadt = lambda r: (20000 / r**2)
+        drdt = None,
+        dthetadt = default_dthetadt
     ):
         """Update the positions of the nodes according to
         dr and dtheta series of differential equations
 
-        drdt and dthetadt are functions
+        drdt and dthetadt are functions, called once on the
+        (N,) array of radii. With a tolerance, they are called at every
+        substep instead; the default drdt then draws its noise once
+        per update, scaled to noise_dt, and holds it over the substeps.
 
         :param dt: Timestep, defaults to 1/60
         :type dt: float, optional
         :param drdt: Function that updates r; defaults per paper
+            (default_drdt, with noise from the swarm's rng)
         :type drdt: Function, optional
         :param dthetadt: Function that updates theta, defaults per paper
         :type dthetadt: Function, optional
         """
-        # todo: redefine update on x, y as entirely functional
-        for node in self.nodes:
-            x, y = node.X[0], node.Y[0]
-            # convert to polar
-            r = (x**2 + y**2)**.5
-            theta = math.atan2(y, x)
-
-            # differential equations defining motion
-            r += drdt(r) * dt
-            theta += dthetadt(r) * dt
+        x, y = self._positions.T
+        if self.tolerance is None:
+            if drdt is None:
+                drdt = lambda r: default_drdt(r, self.rng)
+            self.r, self.theta, x, y = polar_step(x, y, dt, drdt, dthetadt)
+            self.substeps = 1
+        else:
+            if drdt is None:
+                # dt/noise_dt steps of normal(0, 30) noise, each lasting noise_dt,
+                # move a node as far as this noise held for dt
+                noise = self.rng.normal(0, 30*(self.noise_dt/dt)**.5, self.N)
+                drdt = lambda r: default_drift(r) + noise
+            self.r, self.theta, x, y, self.substeps = adaptive_polar_step(
+                x, y, dt, drdt, dthetadt, self.tolerance, self.max_substeps
+            )
+        self._positions = np.stack([x, y], axis=-1)
 
-            # and now update each node
-            x, y = polar_to_xy(r, theta)
-            node.update(x, y, dt)
+        # and now overwrite the oldest row of the history
+        self._head = (self._head + 1) % self.hist_length
+        self._history[self._head] = self._positions
 
     def draw(self, screen = None, tail: bool = True, transform = lambda x: x):
         """Draw all the nodes in the swarm to the screen.
@@ -218,26 +551,63 @@ class Swarm:
         :type screen: pygame.Surface, optional
         :param tail: Draw the node tails, defaults to True
         :type tail: bool, optional
-        :param transform: Transform to apply to each pixel (x,y) coordinate, defaults to lambdax:x
+        :param transform: Transform to apply to each pixel (x,y) coordinate, defaults to lambdax:x.
+            Called once on a tuple of coordinate arrays, so it must work elementwise.
         :type transform: Function, optional
         """
         if screen is None:
             screen = self.screen
-        
-        # draw tails before nodes
-        if tail:
-            for node in self.nodes:
-                node.draw_tail(screen, transform)
-        
-        # draw nodes
-        for node in self.nodes:
-            node.draw(screen, transform)
+
+        draw_swarm(screen, self.history(), tail, transform)
+
+
+def draw_swarm(screen, history, tail: bool = True, transform = lambda x: x):
+    """Draw a swarm from its position history, as Swarm.draw does.
+
+    Only needs the history array, so it can draw a copy
+    while the Swarm itself keeps updating.
+
+    :param screen: PyGame surface
+    :type screen: pygame.Surface
+    :param history: Positions, newest first, shape (hist_length, N, 2) (see Swarm.history)
+    :type history: np.ndarray
+    :param tail: Draw the node tails, defaults to True
+    :type tail: bool, optional
+    :param transform: Transform to apply to each pixel (x,y) coordinate, defaults to lambdax:x.
+        Called once on a tuple of coordinate arrays, so it must work elementwise.
+    :type transform: Function, optional
+    """
+    hist_length, N = history.shape[:2]
+    xs, ys = transform((history[..., 0], history[..., 1]))
+    blit_sequence = []
+
+    # draw tails before nodes, node by node
+    if tail:
+        segments = _tail_sprites(hist_length)
+        if segments:
+            sprites, radii = zip(*segments)
+            radii = np.array(radii)[:, None]
+            corners_x = (xs[:-1] - radii).T.ravel().tolist()
+            corners_y = (ys[:-1] - radii).T.ravel().tolist()
+            blit_sequence += zip(sprites * N, zip(corners_x, corners_y))
+
+    # draw nodes
+    head = _circle_sprite(tuple(S16.white[:3]), 2)
+    blit_sequence += zip([head] * N, zip((xs[0] - 2).tolist(), (ys[0] - 2).tolist()))
+
+    # one batched call for everything
+    screen.blits(blit_sequence, doreturn=False)
 
 
 def example_physical_simulation(
     coordinates: List[Tuple[float, float]],
     dt: float = 1/60,
-    K: int = 10
+    K: int = 10,
+    return_A: bool = False,
+    M = None,
+    rng = None,
+    dtypes: DtypePolicy = FLOAT64,
+    distances = _inverse_square_distances
 ):
     """Example physical-layer simulator as per the paper.
 
@@ -251,50 +621,101 @@ def example_physical_simulation(
     :type dt: float, optional
     :param K: Number of channels, defaults to 10
     :type K: int, optional
+    :param return_A: Build the (N, N, K) loudness tensor A, defaults to False
+    :type return_A: bool, optional
+    :param M: Message matrix to use instead of sampling one, shape (N, K),
+        e.g. to compare two physical layers on the same messages. Defaults to None
+    :type M: np.ndarray, optional
+    :param rng: Seed or generator to sample M with, defaults to None (see as_rng)
+    :type rng: int or np.random.Generator, optional
+    :param dtypes: Dtypes of D, Ar, A and of a sampled M, e.g. FLOAT32.
+        Defaults to FLOAT64
+    :type dtypes: DtypePolicy, optional
+    :param distances: Function building D, called as distances(coordinates, dtype).
+        E.g. kernels.inverse_square_distances_blocked, which guards against
+        coincident nodes. Defaults to kernels.inverse_square_distances
+    :type distances: Function, optional
 
     :returns: Total messages sent, total messages received,
-        plus matrices M, A, and Ar (for experimentation).
+        plus matrices M, D, A, and Ar (for experimentation).
+        A is None unless return_A is set.
     """
     # N = number of nodes
     N = len(coordinates)
 
-    # 1. create D
-    D = np.zeros((N, N))
-    for ii in range(N):
-        xi, yi = coordinates[ii]
-        for jj in range(N):
-            xj, yj = coordinates[jj]
-            # distance^-2 = (Dx^2 + Dy^2)^.5^-2
-            if ii == jj:
-                D[ii,ii] = 0
-            else:
-                D[ii,jj] = ((xi - xj)**2 + (yi - yj)**2)**-1
-        
-        # zero out the diagonal
-        
+    # 1. create D, with a zero diagonal
+    D = distances(np.reshape(coordinates, (N, 2)), dtypes.distance)
 
     # 2. Generate message matrix M according to paper
     # That is, each node creates a message on channel k with probability dt
-    M = (np.random.random((N, K)) < dt).astype(int)
+    if M is None:
+        M = (as_rng(rng).random((N, K)) < dt).astype(dtypes.message)
     
-    # 3. Calculate A' and A
-    Ar = D @ M 
-    A = np.einsum('ij,jk->ijk',D,M) # Loudness per node-pair per message
+    # 3. Calculate A' (and A, only on request)
+    Ar = D @ M
+    A = None
+    if return_A:
+        A = np.einsum('ij,jk->ijk',D,M) # Loudness per node-pair per message
 
     # 4. Calculate metrics
     total_messages_sent = np.sum(M)
-    total_message_received = 0
-    
-    # this can probably be vectorized
-    for ii in range(N):
-      for jj in range(N):
-        for kk in range(K):
-          if Ar[ii, kk] != 0 and A[ii,jj,kk] / Ar[ii, kk] > 1/2:
-            total_message_received += 1
+    total_message_received = _count_receptions(D, M, Ar)
     
     return total_messages_sent, total_message_received, M, D, A, Ar
 
 
+def batched_physical_simulation(
+    coordinates,
+    dt: float = 1/60,
+    K: int = 10,
+    rng = None
+):
+    """example_physical_simulation for R independent networks at once.
+
+    Every step is a stacked array operation over the replica axis.
+
+    :param coordinates: Array of x, y coordinates, shape (R, N, 2)
+    :type coordinates: np.ndarray
+    :param dt: Timestep, defaults to 1/60
+    :type dt: float, optional
+    :param K: Number of channels, defaults to 10
+    :type K: int, optional
+    :param rng: Seed or generator to sample M with, defaults to None (see as_rng)
+    :type rng: int or np.random.Generator, optional
+
+    :returns: Messages sent and received per replica (shape (R,)),
+        plus matrices M, D, and Ar, each with a leading replica axis.
+    """
+    R, N = np.shape(coordinates)[:2]
+
+    D = _inverse_square_distances(coordinates)
+    M = (as_rng(rng).random((R, N, K)) < dt).astype(int)
+    Ar = D @ M
+
+    total_messages_sent = M.sum(axis=(1, 2))
+    total_message_received = _count_receptions_batched(D, M, Ar)
+
+    return total_messages_sent, total_message_received, M, D, Ar
+
+
+def broadcast_throughput(total_received, total_sent, N: int):
+    """Broadcast throughput, i.e. received / (sent * (N-1)).
+
+    :param total_received: Total messages received
+    :type total_received: int
+    :param total_sent: Total messages sent
+    :type total_sent: int
+    :param N: Number of nodes
+    :type N: int
+    :return: Throughput ratio, or nan if nothing could be received
+    :rtype: float
+    """
+    denominator = total_sent * (N - 1)
+    if denominator == 0:
+        return float('nan')
+    return total_received / denominator
+
+
 def draw_M(
     M,
     screen,
@@ -306,6 +727,10 @@ def draw_M(
 ):
     """Draw a summary of the messages being sent by M.
 
+    M[ii,kk] is drawn as a width x width block at column ii, row kk.
+    The whole matrix is colored at once, written into a cached
+    Surface with pygame.surfarray, and drawn with one blit.
+
     :param M: message matrix
     :type M: np.ndarray
     :param screen: PyGame screen
@@ -323,28 +748,36 @@ def draw_M(
     :param C2: Background color, defaults to S16.black
     :type C2: np.ndarray or Tuple
     """
+    import pygame
 
-    N, K = M.shape
-    for ii in range(N):
-        for kk in range(K):
-            color = interpolate_color(C1, C2, 1 - M[ii,kk])
-            #rect = pygame.Rect(
-            #    left   = corner[0] + (width+border)*ii,
-            #    top    = corner[1] + (width+border)*kk,
-            #    width  = width,
-            #    height = width
-            #)
-
-            pygame.draw.rect(
-                surface = screen,
-                color = color,
-                rect = (
-                    corner[0] + (width+border)*ii,
-                    corner[1] + (width+border)*kk,
-                    width,
-                    width
-                )
-            )
+    block = int(width)
+    cell = block + int(border)
+    if np.size(M) == 0 or block == 0:
+        return
+
+    # colors for every cell at once, like interpolate_color(C1, C2, 1 - M[ii,kk])
+    r = np.clip(1 - np.asarray(M, dtype=float), 0, 1)[..., None]
+    colors = np.asarray(C1)[:3] * (1 - r) + np.asarray(C2)[:3] * r
+
+    # one cell x cell square of pixels per entry, with borders keyed out
+    N, K = np.shape(M)
+    pixels = np.empty((N, cell, K, cell, 3), dtype=np.uint8)
+    pixels[:] = _COLORKEY
+    pixels[:, :block, :, :block] = colors.astype(np.uint8)[:, None, :, None]
+    pixels = pixels.reshape(N*cell, K*cell, 3)
+
+    surface = _heatmap_surface(pixels.shape[:2])
+    pygame.surfarray.blit_array(surface, pixels)
+    screen.blit(surface, corner)
+
+@lru_cache(maxsize=16)
+def _heatmap_surface(size: Tuple[int, int]):
+    # Reused target for draw_M, one per size
+    import pygame
+
+    surface = pygame.Surface(size)
+    surface.set_colorkey(_COLORKEY)
+    return surface
 
 def _normalize_safe(A):
     # quick helper function
@@ -353,4 +786,119 @@ def _normalize_safe(A):
     if (maxval - minval) < 0.001:
         return A
     else:
-        return (A - minval)/(maxval - minval)
\ No newline at end of file
+        return (A - minval)/(maxval - minval)
+
+class _Phase:
+    # Reusable timing context for one phase, so timing allocates nothing
+    __slots__ = ('samples', 'total', 'count', '_start')
+
+    def __init__(self, window: int):
+        self.samples = deque(maxlen=window)
+        self.total = 0.0
+        self.count = 0
+        self._start = 0.0
+
+    def __enter__(self):
+        self._start = perf_counter()
+
+    def __exit__(self, *exc):
+        elapsed = perf_counter() - self._start
+        self.samples.append(elapsed)
+        self.total += elapsed
+        self.count += 1
+
+
+_NO_PHASE = nullcontext()
+
+
+class PhaseTimer:
+    """Times named phases of a loop, keeping rolling averages.
+
+    E.g.
+        timer = PhaseTimer()
+        with timer.phase('update'):
+            swarm.update(dt)
+        print(timer.report())
+
+    When disabled, phase() returns a shared no-op context,
+    so the instrumentation can be left in place at almost no cost.
+
+    :param enabled: Time the phases, defaults to True
+    :type enabled: bool, optional
+    :param window: Number of samples in each rolling average, defaults to 60
+    :type window: int, optional
+    """
+    def __init__(self, enabled: bool = True, window: int = 60):
+        self.enabled = enabled
+        self.window = window
+        self._phases = {}
+
+    def phase(self, name: str):
+        """Context manager timing one run of the phase `name`.
+
+        :param name: Phase name. Phases are reported in order of first use
+        :type name: str
+        """
+        if not self.enabled:
+            return _NO_PHASE
+        if name not in self._phases:
+            self._phases[name] = _Phase(self.window)
+        return self._phases[name]
+
+    def averages(self):
+        """Rolling average time per phase, in seconds.
+
+        :return: Phase name to average over the last `window` runs
+        :rtype: Dict[str, float]
+        """
+        return {
+            name: sum(phase.samples) / len(phase.samples)
+            for name, phase in list(self._phases.items()) if phase.samples
+        }
+
+    def lines(self):
+        """One line of text per phase: rolling average in ms, and share of the total.
+
+        :return: Lines, e.g. "update    0.12 ms  3%"
+        :rtype: List[str]
+        """
+        averages = self.averages()
+        total = sum(averages.values())
+        return [
+            f"{name:<10}{1e3*average:7.2f} ms {100*average/total:3.0f}%"
+            for name, average in averages.items()
+        ]
+
+    def draw(self, screen, font, corner = (4, 4), color = S16.white):
+        """Draw the rolling averages as an overlay, one line per phase.
+
+        :param screen: PyGame surface
+        :type screen: pygame.Surface
+        :param font: Font to render with
+        :type font: pygame.freetype.Font
+        :param corner: Top-left corner of the overlay, defaults to (4, 4)
+        :type corner: Tuple[int, int], optional
+        :param color: Text color, defaults to S16.white
+        :type color: Tuple[int, int, int], optional
+        """
+        x, y = corner
+        for line in self.lines():
+            rect = font.render_to(screen, (x, y), line, color)
+            y += rect.height + 2
+
+    def report(self):
+        """Summary over the whole run: calls, mean and total time per phase.
+
+        :return: A markdown table, one row per phase
+        :rtype: str
+        """
+        lines = [
+            "| phase | calls | mean | total |",
+            "| ----- | ----- | ---- | ----- |",
+        ]
+        for name, phase in list(self._phases.items()):
+            if phase.count:
+                lines.append(
+                    f"| {name} | {phase.count} | {1e3*phase.total/phase.count:.3f} ms | {phase.total:.3f} s |"
+                )
+        return "\n".join(lines)